@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray, RawValue
+import random
+import time
+import numpy as np
+
+from q3_word2vec import *
+
+"""
+Hogwild training of word vectors, in the style of the original word2vec
+tool: the input and output vectors live in shared memory, and every worker
+process trains on its own shard of the corpus with its own random state,
+applying sparse updates without any locking. The learning rate decays
+linearly with the number of words processed by all workers together.
+"""
+
+# State shared with the worker processes. It is handed over through the pool
+# initializer, so with the fork start method workers inherit the dataset and
+# the shared buffers instead of receiving pickled copies.
+_state = {}
+
+
+def _init_worker(sharedVectors, shape, wordCount, config):
+    _state['x'] = np.frombuffer(sharedVectors).reshape(shape)
+    _state['wordCount'] = wordCount
+    _state.update(config)
+
+
+def _hogwild_worker(task):
+    shard, iterations, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+    dataset = _state['dataset']
+    dataset.useShard(shard, _state['numWorkers'])
+
+    x, wordCount = _state['x'], _state['wordCount']
+    step, batchsize = _state['step'], _state['batchsize']
+    totalWords = float(_state['totalWords'])
+    costs = []
+    for it in xrange(iterations):
+        lr = step * max(1.0 - wordCount.value / totalWords, 1e-4)
+        cost, grad = word2vec_batch_sgd_wrapper(
+            _state['word2vecModel'], _state['tokens'], x, dataset, _state['C'],
+            _state['word2vecCostAndGradient'], batchsize)
+        x[grad.rows] -= lr * grad.values
+        # Unsynchronised, like word_count_actual in word2vec.c
+        wordCount.value += batchsize
+        costs.append(cost)
+    return costs
+
+
+def hogwild_sgd(word2vecModel, tokens, wordVectors, dataset, C,
+                word2vecCostAndGradient, step, iterations, numWorkers=None,
+                batchsize=50, seed=0):
+    """ Train word vectors with lock-free parallel SGD
+
+    Arguments:
+    word2vecModel, tokens, dataset, C, word2vecCostAndGradient -- as
+        for word2vec_batch_sgd_wrapper; dataset must be a
+        StanfordSentiment, so that it can be sharded
+    wordVectors -- initial input vectors stacked on output vectors
+    step -- initial learning rate, decayed linearly to 1e-4 * step
+    iterations -- total number of minibatches, split across workers
+    numWorkers -- number of processes; defaults to the number of CPUs
+    seed -- base seed of the per-worker random states
+
+    Return:
+    x -- the trained word vectors
+    costs -- minibatch costs, interleaved across the workers
+    wordsPerSec -- center words processed per second
+    """
+    if numWorkers is None:
+        numWorkers = multiprocessing.cpu_count()
+    # Build everything the workers share before forking
+    dataset.corpus()
+    dataset.rejectProb()
+    dataset.sampleTable()
+
+    sharedVectors = RawArray('d', wordVectors.size)
+    x = np.frombuffer(sharedVectors).reshape(wordVectors.shape)
+    x[:] = wordVectors
+    wordCount = RawValue('d', 0)
+    perWorker = max(iterations // numWorkers, 1)
+    config = dict(dataset=dataset, tokens=tokens, C=C,
+                  word2vecModel=word2vecModel,
+                  word2vecCostAndGradient=word2vecCostAndGradient,
+                  step=step, batchsize=batchsize, numWorkers=numWorkers,
+                  totalWords=perWorker * numWorkers * batchsize)
+
+    startTime = time.time()
+    pool = multiprocessing.Pool(numWorkers, initializer=_init_worker,
+                                initargs=(sharedVectors, wordVectors.shape,
+                                          wordCount, config))
+    try:
+        tasks = [(i, perWorker, seed + i) for i in xrange(numWorkers)]
+        perWorkerCosts = pool.map(_hogwild_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - startTime
+
+    costs = [c for step in zip(*perWorkerCosts) for c in step]
+    wordsPerSec = perWorker * numWorkers * batchsize / elapsed
+    return x.copy(), costs, wordsPerSec
+
+
+if __name__ == "__main__":
+    import sys
+    from utils.treebank import StanfordSentiment
+
+    numWorkers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    random.seed(314)
+    dataset = StanfordSentiment()
+    tokens = dataset.tokens()
+    nWords = len(tokens)
+    dimVectors = 10
+    C = 5
+
+    random.seed(31415)
+    np.random.seed(9265)
+    wordVectors = np.concatenate(
+        ((np.random.rand(nWords, dimVectors) - 0.5) /
+           dimVectors, np.zeros((nWords, dimVectors))),
+        axis=0)
+    wordVectors, costs, wordsPerSec = hogwild_sgd(
+        skipgram, tokens, wordVectors, dataset, C,
+        negSamplingCostAndGradient, 0.3, 40000, numWorkers)
+
+    print "final cost (last 1000 minibatches): %f" % np.mean(costs[-1000:])
+    print "%d words/sec" % wordsPerSec
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from q3_word2vec import normalizeRows
+
+"""
+Nearest-neighbour and analogy queries over trained word vectors. Vectors are
+L2-normalised once, so cosine similarity is a dot product; queries are
+answered in batches with blocked matrix products and argpartition, or, for
+large vocabularies, by scanning only the closest clusters of a coarse
+inverted-file (IVF) index.
+"""
+
+
+def _topk(scores, k):
+    """ Column indices of the k largest entries of each row, best first """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    rows = np.arange(scores.shape[0])[:, None]
+    return part[rows, np.argsort(-scores[rows, part], axis=1)]
+
+
+class WordVectorIndex(object):
+    """ Top-k cosine similarity and analogy queries over word vectors
+
+    Example usage:
+
+    index = WordVectorIndex(wordVectors, tokens)
+    index.similar(["good", "bad"], k=5)
+    index.analogy("king", "man", "woman")
+    """
+
+    def __init__(self, wordVectors, tokens, blockSize=4096, numLists=None,
+                 numProbes=8, numIters=10, seed=0):
+        """
+        Arguments:
+        wordVectors -- word vectors (as rows) for all tokens
+        tokens -- a dictionary that maps words to their indices in
+                  wordVectors
+        blockSize -- number of vocabulary rows scored per matrix product
+        numLists -- number of clusters of the IVF index, or None for
+                    exact search
+        numProbes -- number of closest clusters scanned per query
+        numIters -- k-means iterations used to build the IVF index
+        """
+        self.vectors = np.ascontiguousarray(normalizeRows(wordVectors),
+                                            dtype=np.float32)
+        self.tokens = tokens
+        self.revtokens = [None] * len(tokens)
+        for word, i in tokens.iteritems():
+            self.revtokens[i] = word
+        self.blockSize = blockSize
+        self.numProbes = numProbes
+        self.centroids = None
+        if numLists:
+            self._buildIVF(numLists, numIters, np.random.RandomState(seed))
+
+    def _buildIVF(self, numLists, numIters, rng):
+        """ Spherical k-means: cluster by cosine to unit-norm centroids """
+        V = self.vectors.shape[0]
+        if numLists > V:
+            raise ValueError("numLists (%d) exceeds the vocabulary size (%d)"
+                             % (numLists, V))
+        if numIters < 0:
+            raise ValueError("numIters must be non-negative, got %d" % numIters)
+        centroids = self.vectors[rng.choice(V, numLists, replace=False)]
+        for _ in xrange(numIters):
+            assign = self._nearestCentroids(self.vectors, centroids, 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, self.vectors)
+            empty = np.bincount(assign, minlength=numLists) == 0
+            sums[empty] = self.vectors[rng.choice(V, empty.sum(), replace=False)]
+            centroids = normalizeRows(sums).astype(np.float32)
+        # Inverted lists follow the final centroids
+        assign = self._nearestCentroids(self.vectors, centroids, 1)[:, 0]
+        self.centroids = centroids
+        self.order = np.argsort(assign, kind="mergesort")
+        counts = np.bincount(assign, minlength=numLists)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def _nearestCentroids(self, queries, centroids, n):
+        out = []
+        for i in xrange(0, queries.shape[0], self.blockSize):
+            out.append(_topk(queries[i:i + self.blockSize].dot(centroids.T), n))
+        return np.concatenate(out)
+
+    def search(self, queries, k=10, exclude=None):
+        """ Top-k most cosine-similar vocabulary rows for each query
+
+        Arguments:
+        queries -- array of shape (Q, d) of query vectors
+        k -- number of neighbours
+        exclude -- optional integer array of shape (Q, m) of word
+                   indices that may not be returned for each query
+
+        Return:
+        indices -- integer array of shape (Q, k), most similar first
+        scores -- array of shape (Q, k) of cosine similarities
+        """
+        queries = normalizeRows(np.atleast_2d(queries)).astype(np.float32)
+        if exclude is None:
+            exclude = np.zeros((queries.shape[0], 0), dtype=np.int64)
+        exclude = np.asarray(exclude).reshape(queries.shape[0], -1)
+        if self.centroids is not None:
+            return self._searchIVF(queries, k, exclude)
+
+        Q, V = queries.shape[0], self.vectors.shape[0]
+        k = min(k, V)
+        bestIdx = np.zeros((Q, 0), dtype=np.int64)
+        bestScores = np.zeros((Q, 0), dtype=np.float32)
+        for start in xrange(0, V, self.blockSize):
+            block = self.vectors[start:start + self.blockSize]
+            scores = queries.dot(block.T)
+            inBlock = (exclude >= start) & (exclude < start + block.shape[0])
+            rows = np.nonzero(inBlock)[0]
+            scores[rows, exclude[inBlock] - start] = -np.inf
+
+            # Merge the block into the running top k
+            scores = np.hstack((bestScores, scores))
+            idx = np.hstack((bestIdx, np.broadcast_to(
+                np.arange(start, start + block.shape[0]), (Q, block.shape[0]))))
+            top = _topk(scores, k)
+            rows = np.arange(Q)[:, None]
+            bestIdx, bestScores = idx[rows, top], scores[rows, top]
+        return bestIdx, bestScores
+
+    def _searchIVF(self, queries, k, exclude):
+        probes = self._nearestCentroids(queries, self.centroids, self.numProbes)
+        indices = np.zeros((queries.shape[0], k), dtype=np.int64)
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for i in xrange(queries.shape[0]):
+            cand = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]]
+                                   for l in probes[i]])
+            cand = cand[~np.in1d(cand, exclude[i])]
+            s = self.vectors[cand].dot(queries[i])
+            top = _topk(s[None], k)[0]
+            indices[i, :top.shape[0]] = cand[top]
+            scores[i, :top.shape[0]] = s[top]
+        return indices, scores
+
+    def _words(self, indices, scores):
+        return [[(self.revtokens[j], float(s)) for j, s in zip(row, srow)
+                 if np.isfinite(s)] for row, srow in zip(indices, scores)]
+
+    def similar(self, words, k=10):
+        """ The k words most similar to each of words, excluding itself
+
+        Return:
+        A list with one list of (word, similarity) pairs per word
+        """
+        ids = np.array([self.tokens[w] for w in words])
+        indices, scores = self.search(self.vectors[ids], k, ids[:, None])
+        return self._words(indices, scores)
+
+    def analogy(self, a, b, c, k=1):
+        """ Words closest to a - b + c, e.g. analogy("king", "man", "woman")
+
+        a, b and c may be single words or equally long lists of words,
+        for a batch of analogies. The query words themselves are never
+        returned.
+
+        Return:
+        A list with one list of (word, similarity) pairs per analogy
+        """
+        if isinstance(a, basestring):
+            a, b, c = [a], [b], [c]
+        ids = np.array([[self.tokens[w] for w in words] for words in zip(a, b, c)])
+        queries = (self.vectors[ids[:, 0]] - self.vectors[ids[:, 1]] +
+                   self.vectors[ids[:, 2]])
+        indices, scores = self.search(queries, k, ids)
+        return self._words(indices, scores)
+
+
+if __name__ == "__main__":
+    import sys
+    from utils.treebank import StanfordSentiment
+    from q3_sgd import load_saved_params
+
+    dataset = StanfordSentiment()
+    tokens = dataset.tokens()
+    nWords = len(tokens)
+    _, wordVectors, _ = load_saved_params()
+    index = WordVectorIndex(wordVectors[:nWords] + wordVectors[nWords:], tokens)
+
+    words = sys.argv[1:] or ["good", "bad", "movie", "funny"]
+    for word, neighbours in zip(words, index.similar(words, k=5)):
+        print "%s: %s" % (word, ", ".join("%s (%.3f)" % n for n in neighbours))
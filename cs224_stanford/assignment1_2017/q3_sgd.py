@@ -4,17 +4,137 @@
 SAVE_PARAMS_EVERY = 5000
 
 import glob
+import json
+import os
 import random
+import threading
 import numpy as np
 import os.path as op
 import cPickle as pickle
 
 
-def load_saved_params():
-    """
-    A helper function that loads previously saved parameters and resets
-    iteration start.
+def _getRandomState():
+    """ Python and numpy random states, as plain arrays for np.savez """
+    version, internal, gauss = random.getstate()
+    npName, npKeys, npPos, npHasGauss, npGauss = np.random.get_state()
+    return dict(
+        rng_version=np.array(version),
+        rng_internal=np.array(internal, dtype=np.int64),
+        rng_gauss=np.array(np.nan if gauss is None else gauss),
+        np_rng_keys=npKeys,
+        np_rng_pos=np.array(npPos),
+        np_rng_gauss=np.array([npHasGauss, npGauss], dtype=np.float64))
+
+
+def _setRandomState(state):
+    if isinstance(state, tuple) and len(state) == 3:
+        # Legacy checkpoints only hold the Python random state
+        random.setstate(state)
+        return
+    gauss = float(state["rng_gauss"])
+    random.setstate((int(state["rng_version"]),
+                     tuple(int(i) for i in state["rng_internal"]),
+                     None if np.isnan(gauss) else gauss))
+    np.random.set_state(("MT19937", state["np_rng_keys"],
+                         int(state["np_rng_pos"]),
+                         int(state["np_rng_gauss"][0]),
+                         float(state["np_rng_gauss"][1])))
+
+
+def _atomicWrite(path, write):
+    """ Call write(f) on a temporary file, then rename it over path """
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmpPath, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpPath, path)
+
+
+class CheckpointManager(object):
+    """ Crash-safe checkpoints of SGD parameters and random states
+
+    Each checkpoint is a real .npz file written to a temporary file and
+    renamed into place, so a crash never leaves a partial checkpoint.
+    A JSON manifest lists the retained checkpoints; only the last keep
+    are retained. With background=True the files are written by a
+    thread so that SGD does not wait for the disk.
     """
+
+    def __init__(self, directory=".", prefix="saved_params", keep=3,
+                 background=True):
+        if keep < 1:
+            raise ValueError("keep must be at least 1, got %d" % keep)
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        self.background = background
+        self.manifestPath = op.join(directory, prefix + ".json")
+        self._thread = None
+        self._error = None
+
+    def path(self, iter):
+        return op.join(self.directory, "%s_%d.npz" % (self.prefix, iter))
+
+    def _readManifest(self):
+        if not op.exists(self.manifestPath):
+            return []
+        with open(self.manifestPath, "r") as f:
+            return json.load(f)["checkpoints"]
+
+    def save(self, iter, params):
+        """ Checkpoint params together with the current random states
+
+        params is copied before this returns, so it may be updated in
+        place while the checkpoint is being written.
+        """
+        self.wait()
+        arrays = _getRandomState()
+        arrays["params"] = np.array(params, copy=True)
+        if self.background:
+            self._thread = threading.Thread(target=self._write,
+                                            args=(iter, arrays))
+            self._thread.start()
+        else:
+            self._write(iter, arrays)
+
+    def _write(self, iter, arrays):
+        try:
+            _atomicWrite(self.path(iter), lambda f: np.savez(f, **arrays))
+            checkpoints = [i for i in self._readManifest() if i != iter]
+            checkpoints.append(iter)
+            removed, checkpoints = checkpoints[:-self.keep], checkpoints[-self.keep:]
+            _atomicWrite(self.manifestPath, lambda f: json.dump(
+                {"latest": iter, "checkpoints": checkpoints}, f))
+            for i in removed:
+                if op.exists(self.path(i)):
+                    os.remove(self.path(i))
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """ Block until the last checkpoint is on disk """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def load_latest(self):
+        """ Return (iter, params, state) of the latest checkpoint, or
+        (0, None, None) if there is none. """
+        self.wait()
+        checkpoints = self._readManifest()
+        if not checkpoints:
+            return 0, None, None
+        with np.load(self.path(checkpoints[-1])) as data:
+            state = dict((k, data[k]) for k in data.files if k != "params")
+            return checkpoints[-1], data["params"], state
+
+
+def _load_legacy_params():
+    """ Latest checkpoint in the old pickled saved_params_%d.npy format """
     st = 0
     for f in glob.glob("saved_params_*.npy"):
         iter = int(op.splitext(op.basename(f))[0].split("_")[2])
@@ -30,14 +150,45 @@ def load_saved_params():
         return st, None, None
 
 
-def save_params(iter, params):
-    with open("saved_params_%d.npy" % iter, "w") as f:
-        pickle.dump(params, f)
-        pickle.dump(random.getstate(), f)
+def load_saved_params(checkpoints=None):
+    """
+    A helper function that loads previously saved parameters and resets
+    iteration start.
+    """
+    if checkpoints is None:
+        checkpoints = CheckpointManager()
+    st, params, state = checkpoints.load_latest()
+    if st == 0:
+        return _load_legacy_params()
+    return st, params, state
+
+
+def save_params(iter, params, checkpoints=None):
+    if checkpoints is None:
+        checkpoints = CheckpointManager(background=False)
+    checkpoints.save(iter, params)
+
+
+class SparseGrad(object):
+    """ A gradient that is zero outside a few rows
+
+    The dense gradient has the given shape and dense[rows] == values;
+    rows must not repeat. sgd applies it by updating only those rows.
+    """
+
+    def __init__(self, shape, rows, values):
+        self.shape = shape
+        self.rows = rows
+        self.values = values
+
+    def toarray(self):
+        dense = np.zeros(self.shape)
+        dense[self.rows] = self.values
+        return dense
 
 
 def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
-        PRINT_EVERY=10):
+        PRINT_EVERY=10, checkpoints=None):
     """ Stochastic Gradient Descent
 
     Implement the stochastic gradient descent method in this function.
@@ -45,7 +196,8 @@ def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
     Arguments:
     f -- the function to optimize, it should take a single
          argument and yield two outputs, a cost and the gradient
-         with respect to the arguments
+         with respect to the arguments. The gradient may be a
+         SparseGrad, in which case x0 is updated in place.
     x0 -- the initial point to start SGD from
     step -- the step size for SGD
     iterations -- total iterations to run SGD for
@@ -53,6 +205,8 @@ def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
                       if necessary. In the case of word2vec we will need to
                       normalize the word vectors to have unit length.
     PRINT_EVERY -- specifies how many iterations to output loss
+    checkpoints -- CheckpointManager used when useSaved is set;
+                   defaults to one in the working directory
 
     Return:
     x -- the parameter value after SGD finishes
@@ -62,13 +216,15 @@ def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
     ANNEAL_EVERY = 20000
 
     if useSaved:
-        start_iter, oldx, state = load_saved_params()
+        if checkpoints is None:
+            checkpoints = CheckpointManager()
+        start_iter, oldx, state = load_saved_params(checkpoints)
         if start_iter > 0:
             x0 = oldx
             step *= 0.5 ** (start_iter / ANNEAL_EVERY)
 
         if state:
-            random.setstate(state)
+            _setRandomState(state)
     else:
         start_iter = 0
 
@@ -85,7 +241,12 @@ def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
 
         cost = None
         ### YOUR CODE HERE
-        raise NotImplementedError
+        cost, grad = f(x)
+        if isinstance(grad, SparseGrad):
+            x[grad.rows] -= step * grad.values
+        else:
+            x = x - step * grad
+        x = postprocessing(x)
         ### END YOUR CODE
 
         if iter % PRINT_EVERY == 0:
@@ -96,11 +257,13 @@ def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
             print "iter %d: %f" % (iter, expcost)
 
         if iter % SAVE_PARAMS_EVERY == 0 and useSaved:
-            save_params(iter, x)
+            save_params(iter, x, checkpoints)
 
         if iter % ANNEAL_EVERY == 0:
             step *= 0.5
 
+    if useSaved:
+        checkpoints.wait()
     return x
 
 
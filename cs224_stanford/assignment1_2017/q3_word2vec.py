@@ -6,6 +6,7 @@ import random
 from q1_softmax import softmax
 from q2_gradcheck import gradcheck_naive
 from q2_sigmoid import sigmoid, sigmoid_grad
+from q3_sgd import SparseGrad
 
 def normalizeRows(x):
     """ Row normalization function
@@ -15,7 +16,7 @@ def normalizeRows(x):
     """
 
     ### YOUR CODE HERE
-    raise NotImplementedError
+    x = x / np.maximum(np.sqrt(np.sum(x ** 2, axis=1, keepdims=True)), 1e-12)
     ### END YOUR CODE
 
     return x
@@ -161,6 +162,207 @@ def cbow(currentWord, C, contextWords, tokens, inputVectors, outputVectors,
     return cost, gradIn, gradOut
 
 
+def getNegativeSamplesBatch(targets, dataset, K):
+    """ Samples K indexes for each target, none of them equal to it
+
+    Arguments:
+    targets -- integer array of shape (P,)
+
+    Return:
+    indices -- integer array of shape (P, K)
+    """
+    targets = np.asarray(targets)
+    if not hasattr(dataset, "sampleTokenIdxs"):
+        indices = np.empty((targets.shape[0], K), dtype=np.int64)
+        for i in xrange(targets.shape[0]):
+            indices[i] = getNegativeSamples(targets[i], dataset, K)
+        return indices
+
+    # Draw everything at once, then redraw only the collisions
+    indices = dataset.sampleTokenIdxs((targets.shape[0], K)).astype(np.int64)
+    collide = np.nonzero(indices == targets[:, None])
+    while collide[0].shape[0] > 0:
+        indices[collide] = dataset.sampleTokenIdxs(collide[0].shape[0])
+        collide = np.nonzero(indices == targets[:, None])
+    return indices
+
+
+def _sigmoid(x):
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+
+def softmaxBatchCostAndGradient(predicted, targets, outputVectors, dataset):
+    """ Batched softmaxCostAndGradient
+
+    Arguments:
+    predicted -- numpy ndarray of shape (P, d), one predicted word
+                 vector per row
+    targets -- integer array of shape (P,), the target of each row
+    outputVectors, dataset -- as for softmaxCostAndGradient
+
+    Return:
+    cost -- array of shape (P,), the cost of each prediction
+    gradPred -- array of shape (P, d), the gradient with respect to
+                each predicted vector
+    outRows -- integer array of the rows of outputVectors that have
+               a gradient
+    outGrad -- array of shape (len(outRows), d) holding those
+               gradients, summed over the batch; rows may repeat
+    """
+    P = predicted.shape[0]
+    scores = predicted.dot(outputVectors.T)
+    scores -= np.max(scores, axis=1, keepdims=True)
+    logprobs = scores - np.log(np.sum(np.exp(scores), axis=1, keepdims=True))
+    cost = -logprobs[np.arange(P), targets]
+
+    dscores = np.exp(logprobs)
+    dscores[np.arange(P), targets] -= 1
+    gradPred = dscores.dot(outputVectors)
+    outGrad = dscores.T.dot(predicted)
+    return cost, gradPred, np.arange(outputVectors.shape[0]), outGrad
+
+
+def negSamplingBatchCostAndGradient(predicted, targets, outputVectors,
+                                    dataset, K=10):
+    """ Batched negSamplingCostAndGradient
+
+    Only the K + 1 sampled output vectors of each row receive a
+    gradient. Arguments/Return Specifications: same as
+    softmaxBatchCostAndGradient
+    """
+    P, d = predicted.shape
+    indices = np.column_stack((targets,
+                               getNegativeSamplesBatch(targets, dataset, K)))
+    sign = -np.ones(K + 1)
+    sign[0] = 1
+
+    U = outputVectors[indices]                          # (P, K+1, d)
+    scores = np.einsum('pkd,pd->pk', U, predicted) * sign
+    cost = np.sum(np.logaddexp(0, -scores), axis=1)     # -log sigmoid
+
+    dscores = -sign * _sigmoid(-scores)
+    gradPred = np.einsum('pk,pkd->pd', dscores, U)
+    outGrad = dscores[:, :, None] * predicted[:, None, :]
+    return cost, gradPred, indices.ravel(), outGrad.reshape(-1, d)
+
+
+def skipgramBatch(centers, contexts, mask, inputVectors, outputVectors,
+                  dataset, word2vecBatchCostAndGradient):
+    """ Skip-gram model over a batch of center words
+
+    Arguments:
+    centers -- integer array of shape (B,) of center word indices
+    contexts -- integer array of shape (B, 2C) of context word
+                indices, padded arbitrarily where mask is False
+    mask -- boolean array of shape (B, 2C), True for real contexts
+    word2vecBatchCostAndGradient -- softmaxBatchCostAndGradient or
+                                    negSamplingBatchCostAndGradient
+
+    Return:
+    cost -- total cost of the batch
+    inRows, inGrad -- rows of inputVectors and their gradients
+    outRows, outGrad -- rows of outputVectors and their gradients
+    """
+    b, j = np.nonzero(mask)
+    predicted = inputVectors[centers[b]]
+    cost, gradPred, outRows, outGrad = word2vecBatchCostAndGradient(
+        predicted, contexts[b, j], outputVectors, dataset)
+    return np.sum(cost), centers[b], gradPred, outRows, outGrad
+
+
+def cbowBatch(centers, contexts, mask, inputVectors, outputVectors,
+              dataset, word2vecBatchCostAndGradient):
+    """ CBOW model over a batch of center words
+
+    Arguments/Return specifications: same as skipgramBatch
+    """
+    predicted = np.einsum('bj,bjd->bd', mask.astype(inputVectors.dtype),
+                          inputVectors[contexts])
+    cost, gradPred, outRows, outGrad = word2vecBatchCostAndGradient(
+        predicted, centers, outputVectors, dataset)
+    b, j = np.nonzero(mask)
+    return np.sum(cost), contexts[b, j], gradPred[b], outRows, outGrad
+
+
+# Batched counterparts of the per-example model and cost functions
+_BATCH_MODELS = {skipgram: skipgramBatch, cbow: cbowBatch}
+_BATCH_COSTS = {softmaxCostAndGradient: softmaxBatchCostAndGradient,
+                negSamplingCostAndGradient: negSamplingBatchCostAndGradient}
+
+
+def sumRows(rows, values):
+    """ Sum the rows of values that share the same index in rows
+
+    Return:
+    uniqueRows -- sorted unique indices
+    sums -- array of shape (len(uniqueRows), d)
+    """
+    order = np.argsort(rows, kind='mergesort')
+    rows = rows[order]
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    return rows[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
+def word2vecBatchCostAndGradient(word2vecModel, centers, contexts, mask,
+                                 wordVectors, dataset,
+                                 word2vecCostAndGradient=softmaxCostAndGradient):
+    """ Average cost and sparse gradient of a batch of center words
+
+    Arguments:
+    word2vecModel -- skipgram or cbow
+    centers, contexts, mask -- as for skipgramBatch
+    wordVectors -- input vectors stacked on top of output vectors
+    word2vecCostAndGradient -- softmaxCostAndGradient or
+                               negSamplingCostAndGradient
+
+    Return:
+    cost -- the cost averaged over the batch
+    grad -- a SparseGrad with the shape of wordVectors
+    """
+    N = wordVectors.shape[0]
+    inputVectors = wordVectors[:N/2,:]
+    outputVectors = wordVectors[N/2:,:]
+    batchsize = centers.shape[0]
+
+    cost, inRows, inGrad, outRows, outGrad = _BATCH_MODELS[word2vecModel](
+        centers, contexts, mask, inputVectors, outputVectors, dataset,
+        _BATCH_COSTS[word2vecCostAndGradient])
+    rows, values = sumRows(np.concatenate((inRows, outRows + N/2)),
+                           np.concatenate((inGrad, outGrad)))
+    return cost / batchsize, SparseGrad(wordVectors.shape, rows,
+                                        values / batchsize)
+
+
+def word2vec_batch_sgd_wrapper(word2vecModel, tokens, wordVectors, dataset, C,
+                               word2vecCostAndGradient=softmaxCostAndGradient,
+                               batchsize=50):
+    """ Batched version of word2vec_sgd_wrapper
+
+    Draws the same kind of random contexts, in one call if dataset
+    provides getRandomContexts, and computes all of them at once. It
+    returns a SparseGrad that sgd applies in place, so the cost of a
+    step does not grow with the vocabulary size when negative
+    sampling is used.
+    """
+    if hasattr(dataset, "getRandomContexts"):
+        C1 = np.random.randint(1, C + 1, size=batchsize)
+        centers, contexts, mask = dataset.getRandomContexts(C1)
+    else:
+        centers = np.zeros(batchsize, dtype=np.int64)
+        contexts = np.zeros((batchsize, 2 * C), dtype=np.int64)
+        mask = np.zeros((batchsize, 2 * C), dtype=bool)
+        for i in xrange(batchsize):
+            C1 = random.randint(1,C)
+            centerword, context = dataset.getRandomContext(C1)
+            centers[i] = tokens[centerword]
+            contexts[i, :len(context)] = [tokens[w] for w in context]
+            mask[i, :len(context)] = True
+
+    return word2vecBatchCostAndGradient(
+        word2vecModel, centers, contexts, mask, wordVectors, dataset,
+        word2vecCostAndGradient)
+
+
 #############################################
 # Testing functions below. DO NOT MODIFY!   #
 #############################################
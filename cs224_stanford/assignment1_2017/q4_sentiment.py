@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
 import argparse
+import copy
+import json
+import multiprocessing
+import os
+import Queue
 import numpy as np
+import scipy.sparse
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
@@ -26,6 +32,8 @@ def getArguments():
                        help="Use pretrained GloVe vectors.")
     group.add_argument("--yourvectors", dest="yourvectors", action="store_true",
                        help="Use your vectors from q3.")
+    parser.add_argument("--workers", dest="workers", type=int, default=None,
+                        help="Processes for the regularization sweep.")
     return parser.parse_args()
 
 
@@ -49,13 +57,81 @@ def getSentenceFeatures(tokens, wordVectors, sentence):
     sentVector = np.zeros((wordVectors.shape[1],))
 
     ### YOUR CODE HERE
-    raise NotImplementedError
+    counts = sentenceCounts(tokens, [sentence])
+    sentVector = getBatchSentenceFeatures(counts, wordVectors)[0]
     ### END YOUR CODE
 
     assert sentVector.shape == (wordVectors.shape[1],)
     return sentVector
 
 
+def sentenceCounts(tokens, sentences):
+    """
+    Count the tokens of each sentence
+
+    Arguments:
+    tokens -- a dictionary that maps words to their indices in
+              the word vector list
+    sentences -- a list of sentences, each a list of words
+
+    Returns:
+    counts -- scipy.sparse CSR matrix of shape
+              (len(sentences), len(tokens)); counts[i, j] is the
+              number of times token j occurs in sentence i
+    """
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    indices = np.fromiter((tokens[w] for sentence in sentences for w in sentence),
+                          dtype=np.int32, count=int(indptr[-1]))
+    counts = scipy.sparse.csr_matrix(
+        (np.ones(indices.shape[0]), indices, indptr),
+        shape=(len(sentences), len(tokens)))
+    counts.sum_duplicates()
+    return counts
+
+
+def getBatchSentenceFeatures(counts, wordVectors):
+    """
+    Average the word vectors of many sentences at once
+
+    Arguments:
+    counts -- token counts of the sentences, from sentenceCounts
+    wordVectors -- word vectors (each row) for all tokens
+
+    Returns:
+    features -- array of shape (nSentences, dimVectors) whose rows
+                are what getSentenceFeatures returns for each sentence
+    """
+    lengths = np.asarray(counts.sum(axis=1)).ravel()
+    return counts.dot(wordVectors) / np.maximum(lengths, 1)[:, None]
+
+
+# Token counts and labels of each dataset split, built once per process
+# and shared by every embedding and regularization setting
+_splitCache = {}
+
+
+def loadSplit(dataset, tokens, split):
+    """
+    Token counts, labels and sentences of one split of the dataset
+
+    Arguments:
+    split -- 0, 1 or 2 for the train, test or dev sentences
+
+    Returns:
+    counts -- token counts from sentenceCounts
+    labels -- int32 array of the sentence labels
+    sentences -- the (sentence, label) pairs of the split
+    """
+    key = (dataset.path, split)
+    if key not in _splitCache:
+        sentences = dataset.getSplitSentences(split)
+        counts = sentenceCounts(tokens, [words for words, _ in sentences])
+        labels = np.array([label for _, label in sentences], dtype=np.int32)
+        _splitCache[key] = (counts, labels, sentences)
+    return _splitCache[key]
+
+
 def getRegularizationValues():
     """Try different regularizations
 
@@ -100,14 +176,129 @@ def accuracy(y, yhat):
 
 
 def plotRegVsAccuracy(regValues, results, filename):
-    """ Make a plot of regularization vs accuracy """
-    plt.plot(regValues, [x["train"] for x in results])
-    plt.plot(regValues, [x["dev"] for x in results])
+    """ Make a plot of regularization vs accuracy
+
+    results may cover only some of regValues, e.g. while a sweep is
+    still running; only the finished values are plotted.
+    """
+    results = sorted(results, key=lambda x: x["reg"])
+    plt.figure()
+    plt.plot([x["reg"] for x in results], [x["train"] for x in results])
+    plt.plot([x["reg"] for x in results], [x["dev"] for x in results])
     plt.xscale('log')
+    plt.xlim(min(regValues), max(regValues))
     plt.xlabel("regularization")
     plt.ylabel("accuracy")
     plt.legend(['train', 'dev'], loc='upper left')
     plt.savefig(filename)
+    plt.close()
+
+
+# Features shared with the sweep worker processes. They are handed over
+# through the pool initializer, so with the fork start method workers
+# inherit them instead of receiving pickled copies.
+_shared = {}
+
+
+def _initSweepWorker(features, labels, queue):
+    _shared["features"], _shared["labels"] = features, labels
+    _shared["queue"] = queue
+
+
+def _fitPath(regValues):
+    """ Fit one classifier per value of regValues, largest first, each
+    fit warm-started from the previous solution. Yields result
+    dictionaries as in chooseBestModel. """
+    trainFeatures, devFeatures, testFeatures = _shared["features"]
+    trainLabels, devLabels, testLabels = _shared["labels"]
+    # liblinear, the default solver, cannot warm start
+    clf = LogisticRegression(solver="lbfgs", multi_class="multinomial",
+                             warm_start=True)
+    for reg in sorted(regValues, reverse=True):
+        # Note: add a very small number to regularization to please the library
+        clf.set_params(C=1.0/(reg + 1e-12))
+        clf.fit(trainFeatures, trainLabels)
+        yield {
+            "reg": reg,
+            "clf": copy.deepcopy(clf),
+            "train": accuracy(trainLabels, clf.predict(trainFeatures)),
+            "dev": accuracy(devLabels, clf.predict(devFeatures)),
+            "test": accuracy(testLabels, clf.predict(testFeatures))}
+
+
+def _fitPathWorker(regValues):
+    for result in _fitPath(regValues):
+        _shared["queue"].put(result)
+
+
+def regularizationSweep(features, labels, regValues, numWorkers=None,
+                        callback=None):
+    """ Fit a classifier for every regularization value
+
+    The sorted values are split into numWorkers contiguous ranges.
+    Each range is fitted as a warm-started regularization path in its
+    own process, and results are reported as soon as they are ready.
+
+    Arguments:
+    features -- (train, dev, test) feature matrices
+    labels -- (train, dev, test) label arrays
+    regValues -- regularization values to try
+    numWorkers -- number of processes; defaults to the number of CPUs,
+                  1 runs the sweep in this process
+    callback -- called with the list of results so far after every
+                finished fit
+
+    Returns:
+    results -- result dictionaries as in chooseBestModel, sorted by reg
+    """
+    if numWorkers is None:
+        numWorkers = multiprocessing.cpu_count()
+    regValues = sorted(regValues)
+    numWorkers = max(1, min(numWorkers, len(regValues)))
+    ranges = [list(r) for r in np.array_split(regValues, numWorkers)]
+
+    results = []
+    def report(result):
+        results.append(result)
+        print "reg=%.2E train=%.3f dev=%.3f test=%.3f" % (
+            result["reg"], result["train"], result["dev"], result["test"])
+        if callback is not None:
+            callback(results)
+
+    if numWorkers == 1:
+        _initSweepWorker(features, labels, None)
+        for result in _fitPath(regValues):
+            report(result)
+    else:
+        queue = multiprocessing.Queue()
+        pool = multiprocessing.Pool(numWorkers, initializer=_initSweepWorker,
+                                    initargs=(features, labels, queue))
+        try:
+            done = pool.map_async(_fitPathWorker, ranges)
+            while len(results) < len(regValues):
+                try:
+                    report(queue.get(timeout=1))
+                except Queue.Empty:
+                    if done.ready():
+                        done.get()  # re-raises a worker's exception
+                        # Every result has been put, but the last ones may
+                        # still be on their way through the queue's pipe
+                        while len(results) < len(regValues):
+                            report(queue.get())
+        finally:
+            pool.close()
+            pool.join()
+
+    return sorted(results, key=lambda x: x["reg"])
+
+
+def writeResults(results, filename):
+    """ Write the accuracies of the finished fits, one JSON line each """
+    with open(filename + ".tmp", "w") as f:
+        for result in sorted(results, key=lambda x: x["reg"]):
+            print >> f, json.dumps(dict((k, result[k])
+                                        for k in ("reg", "train", "dev", "test")))
+    os.rename(filename + ".tmp", filename)
 
 
 def outputConfusionMatrix(features, labels, clf, filename):
@@ -159,65 +350,26 @@ def main(args):
         wordVectors = glove.loadWordVectors(tokens)
     dimVectors = wordVectors.shape[1]
 
-    # Load the train set
-    trainset = dataset.getTrainSentences()
-    nTrain = len(trainset)
-    trainFeatures = np.zeros((nTrain, dimVectors))
-    trainLabels = np.zeros((nTrain,), dtype=np.int32)
-    for i in xrange(nTrain):
-        words, trainLabels[i] = trainset[i]
-        trainFeatures[i, :] = getSentenceFeatures(tokens, wordVectors, words)
-
-    # Prepare dev set features
-    devset = dataset.getDevSentences()
-    nDev = len(devset)
-    devFeatures = np.zeros((nDev, dimVectors))
-    devLabels = np.zeros((nDev,), dtype=np.int32)
-    for i in xrange(nDev):
-        words, devLabels[i] = devset[i]
-        devFeatures[i, :] = getSentenceFeatures(tokens, wordVectors, words)
-
-    # Prepare test set features
-    testset = dataset.getTestSentences()
-    nTest = len(testset)
-    testFeatures = np.zeros((nTest, dimVectors))
-    testLabels = np.zeros((nTest,), dtype=np.int32)
-    for i in xrange(nTest):
-        words, testLabels[i] = testset[i]
-        testFeatures[i, :] = getSentenceFeatures(tokens, wordVectors, words)
-
-    # We will save our results from each run
-    results = []
-    regValues = getRegularizationValues()
-    for reg in regValues:
-        print "Training for reg=%f" % reg
-        # Note: add a very small number to regularization to please the library
-        clf = LogisticRegression(C=1.0/(reg + 1e-12))
-        clf.fit(trainFeatures, trainLabels)
-
-        # Test on train set
-        pred = clf.predict(trainFeatures)
-        trainAccuracy = accuracy(trainLabels, pred)
-        print "Train accuracy (%%): %f" % trainAccuracy
+    # Load the train, dev and test sets
+    trainCounts, trainLabels, trainset = loadSplit(dataset, tokens, 0)
+    devCounts, devLabels, devset = loadSplit(dataset, tokens, 2)
+    testCounts, testLabels, testset = loadSplit(dataset, tokens, 1)
+    trainFeatures = getBatchSentenceFeatures(trainCounts, wordVectors)
+    devFeatures = getBatchSentenceFeatures(devCounts, wordVectors)
+    testFeatures = getBatchSentenceFeatures(testCounts, wordVectors)
 
-        # Test on dev set
-        pred = clf.predict(devFeatures)
-        devAccuracy = accuracy(devLabels, pred)
-        print "Dev accuracy (%%): %f" % devAccuracy
-
-        # Test on test set
-        # Note: always running on test is poor style. Typically, you should
-        # do this only after validation.
-        pred = clf.predict(testFeatures)
-        testAccuracy = accuracy(testLabels, pred)
-        print "Test accuracy (%%): %f" % testAccuracy
+    # We will save our results from each run, and write them out as
+    # they come in so that a running sweep can be inspected
+    regValues = getRegularizationValues()
+    def saveProgress(results):
+        writeResults(results, "q4_reg_results.txt")
+        if args.pretrained:
+            plotRegVsAccuracy(regValues, results, "q4_reg_v_acc.png")
 
-        results.append({
-            "reg": reg,
-            "clf": clf,
-            "train": trainAccuracy,
-            "dev": devAccuracy,
-            "test": testAccuracy})
+    results = regularizationSweep(
+        (trainFeatures, devFeatures, testFeatures),
+        (trainLabels, devLabels, testLabels),
+        regValues, args.workers, saveProgress)
 
     # Print the accuracies
     print ""
@@ -237,7 +389,6 @@ def main(args):
 
     # do some error analysis
     if args.pretrained:
-        plotRegVsAccuracy(regValues, results, "q4_reg_v_acc.png")
         outputConfusionMatrix(devFeatures, devLabels, bestResult["clf"],
                               "q4_dev_conf.png")
         outputPredictions(devset, devFeatures, devLabels, bestResult["clf"],
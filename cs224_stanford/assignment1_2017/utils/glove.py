@@ -1,22 +1,70 @@
-
+import os
 import numpy as np
 
 DEFAULT_FILE_PATH = "utils/datasets/glove.6B.50d.txt"
 
-def loadWordVectors(tokens, filepath=DEFAULT_FILE_PATH, dimensions=50):
-    """Read pretrained GloVe vectors"""
-    wordVectors = np.zeros((len(tokens), dimensions))
+def _binaryPaths(filepath):
+    return filepath + ".npy", filepath + ".vocab"
+
+def convertWordVectors(filepath=DEFAULT_FILE_PATH, dimensions=50):
+    """Convert a GloVe text file to a float32 .npy matrix and a vocab file
+
+    The matrix is written through a memory map, so files larger than
+    RAM can be converted. Row i of the matrix belongs to the token on
+    line i of the vocab file.
+    """
+    npyPath, vocabPath = _binaryPaths(filepath)
     with open(filepath) as ifs:
+        nRows = sum(1 for line in ifs if line.strip())
+
+    tmpNpy, tmpVocab = npyPath + ".tmp", vocabPath + ".tmp"
+    matrix = np.lib.format.open_memmap(tmpNpy, mode="w+", dtype=np.float32,
+                                       shape=(nRows, dimensions))
+    i = 0
+    with open(filepath) as ifs, open(tmpVocab, "w") as vocab:
         for line in ifs:
             line = line.strip()
             if not line:
                 continue
             row = line.split()
-            token = row[0]
-            if token not in tokens:
-                continue
-            data = [float(x) for x in row[1:]]
-            if len(data) != dimensions:
+            if len(row) - 1 != dimensions:
                 raise RuntimeError("wrong number of dimensions")
-            wordVectors[tokens[token]] = np.asarray(data)
+            matrix[i] = np.array(row[1:], dtype=np.float32)
+            vocab.write(row[0] + "\n")
+            i += 1
+    matrix.flush()
+    del matrix
+    os.rename(tmpVocab, vocabPath)
+    os.rename(tmpNpy, npyPath)
+
+def loadWordVectors(tokens, filepath=DEFAULT_FILE_PATH, dimensions=50):
+    """Read pretrained GloVe vectors
+
+    The text file is converted once with convertWordVectors; later
+    calls memory-map the binary matrix and only read the rows of
+    tokens in the vocabulary. The text file is not needed after the
+    conversion.
+    """
+    npyPath, vocabPath = _binaryPaths(filepath)
+    haveBinary = os.path.exists(npyPath) and os.path.exists(vocabPath)
+    if os.path.exists(filepath):
+        # The text file may be deleted once it has been converted
+        if not haveBinary or os.path.getmtime(npyPath) < os.path.getmtime(filepath):
+            convertWordVectors(filepath, dimensions)
+    elif not haveBinary:
+        raise IOError("no word vectors at %s or %s / %s"
+                      % (filepath, npyPath, vocabPath))
+
+    matrix = np.load(npyPath, mmap_mode="r")
+    if matrix.shape[1] != dimensions:
+        raise RuntimeError("wrong number of dimensions")
+    with open(vocabPath) as f:
+        index = dict((line.rstrip("\n"), i) for i, line in enumerate(f))
+
+    wordVectors = np.zeros((len(tokens), dimensions))
+    found = [(tokens[token], i) for token, i in index.iteritems() if token in tokens]
+    if found:
+        ours, rows = (np.array(x) for x in zip(*found))
+        order = np.argsort(rows)  # read the memory map front to back
+        wordVectors[ours[order]] = matrix[rows[order]]
     return wordVectors
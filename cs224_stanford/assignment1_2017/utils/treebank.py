@@ -14,35 +14,84 @@ class StanfordSentiment:
         self.path = path
         self.tablesize = tablesize
 
-    def tokens(self):
-        if hasattr(self, "_tokens") and self._tokens:
-            return self._tokens
+    def _sourcePaths(self):
+        return [self.path + "/" + name for name in (
+            "datasetSentences.txt", "dictionary.txt",
+            "sentiment_labels.txt", "datasetSplit.txt")]
+
+    def cachePath(self):
+        return self.path + "/dataset_cache.npz"
+
+    def writeCache(self):
+        """ Parse the dataset files once into a compact binary cache
+
+        The cache holds the vocabulary and token counts, the sentences
+        as token ids, and, when their files are present, the sentence
+        labels and split assignments.
+        """
+        sentences = self._parseSentences()
 
         tokens = dict()
-        tokenfreq = dict()
-        wordcount = 0
         revtokens = []
-        idx = 0
-
-        for sentence in self.sentences():
+        counts = []
+        for sentence in sentences:
             for w in sentence:
-                wordcount += 1
                 if not w in tokens:
-                    tokens[w] = idx
+                    tokens[w] = len(revtokens)
                     revtokens += [w]
-                    tokenfreq[w] = 1
-                    idx += 1
+                    counts += [1]
                 else:
-                    tokenfreq[w] += 1
-
-        tokens["UNK"] = idx
+                    counts[tokens[w]] += 1
         revtokens += ["UNK"]
-        tokenfreq["UNK"] = 1
-        wordcount += 1
+        counts += [1]
+
+        lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+        arrays = dict(
+            vocab=np.array(revtokens),
+            counts=np.array(counts, dtype=np.int64),
+            ids=np.fromiter((tokens[w] for s in sentences for w in s),
+                            dtype=np.int32, count=int(lengths.sum())),
+            offsets=np.concatenate(([0], np.cumsum(lengths))))
+
+        _, dictionaryPath, labelsPath, splitPath = self._sourcePaths()
+        if os.path.exists(dictionaryPath) and os.path.exists(labelsPath):
+            arrays["labels"] = np.array(self._parseLabels(sentences))
+        if os.path.exists(splitPath):
+            split = np.full(len(sentences), -1, dtype=np.int8)
+            for i, ids in enumerate(self._parseSplit()):
+                split[ids] = i
+            arrays["split"] = split
+
+        tmpPath = "%s.%d.tmp" % (self.cachePath(), os.getpid())
+        with open(tmpPath, "wb") as f:
+            np.savez(f, **arrays)
+        os.rename(tmpPath, self.cachePath())
+
+    def _cache(self):
+        """ Arrays of the binary cache, rebuilt if any source is newer """
+        if hasattr(self, "_cacheArrays") and self._cacheArrays:
+            return self._cacheArrays
+
+        path = self.cachePath()
+        newest = max([0] + [os.path.getmtime(f) for f in self._sourcePaths()
+                            if os.path.exists(f)])
+        if not os.path.exists(path) or os.path.getmtime(path) < newest:
+            self.writeCache()
+        with np.load(path) as data:
+            self._cacheArrays = dict((k, data[k]) for k in data.files)
+        return self._cacheArrays
+
+    def tokens(self):
+        if hasattr(self, "_tokens") and self._tokens:
+            return self._tokens
+
+        cache = self._cache()
+        revtokens = cache["vocab"].tolist()
+        counts = cache["counts"].tolist()
 
-        self._tokens = tokens
-        self._tokenfreq = tokenfreq
-        self._wordcount = wordcount
+        self._tokens = dict((w, i) for i, w in enumerate(revtokens))
+        self._tokenfreq = dict(zip(revtokens, counts))
+        self._wordcount = sum(counts)
         self._revtokens = revtokens
         return self._tokens
 
@@ -50,6 +99,19 @@ class StanfordSentiment:
         if hasattr(self, "_sentences") and self._sentences:
             return self._sentences
 
+        self.tokens()
+        ids, offsets = self.corpus()
+        words = np.array(self._revtokens, dtype=object)[ids]
+        sentences = [words[offsets[i]:offsets[i + 1]].tolist()
+                     for i in xrange(offsets.shape[0] - 1)]
+
+        self._sentences = sentences
+        self._sentlengths = np.diff(offsets)
+        self._cumsentlen = np.cumsum(self._sentlengths)
+
+        return self._sentences
+
+    def _parseSentences(self):
         sentences = []
         with open(self.path + "/datasetSentences.txt", "r") as f:
             first = True
@@ -61,59 +123,136 @@ class StanfordSentiment:
                 splitted = line.strip().split()[1:]
                 # Deal with some peculiar encoding issues with this file
                 sentences += [[w.lower().decode("utf-8").encode('latin1') for w in splitted]]
-
-        self._sentences = sentences
-        self._sentlengths = np.array([len(s) for s in sentences])
-        self._cumsentlen = np.cumsum(self._sentlengths)
-
-        return self._sentences
+        return sentences
 
     def numSentences(self):
         if hasattr(self, "_numSentences") and self._numSentences:
             return self._numSentences
         else:
-            self._numSentences = len(self.sentences())
+            self._numSentences = self.corpus()[1].shape[0] - 1
             return self._numSentences
 
-    def allSentences(self):
-        if hasattr(self, "_allsentences") and self._allsentences:
-            return self._allsentences
-
-        sentences = self.sentences()
-        rejectProb = self.rejectProb()
-        tokens = self.tokens()
-        allsentences = [[w for w in s
-            if 0 >= rejectProb[tokens[w]] or random.random() >= rejectProb[tokens[w]]]
-            for s in sentences * 30]
-
-        allsentences = [s for s in allsentences if len(s) > 1]
-
-        self._allsentences = allsentences
-
-        return self._allsentences
+    def corpus(self):
+        """ The corpus as one flat array of token ids
+
+        Sentence i is ids[offsets[i]:offsets[i+1]]. Both arrays come
+        from the binary dataset cache.
+
+        Return:
+        ids -- int32 array of all tokens of all sentences
+        offsets -- int64 array of shape (numSentences() + 1,)
+        """
+        if hasattr(self, "_corpus") and self._corpus:
+            return self._corpus
+
+        cache = self._cache()
+        self._corpus = (cache["ids"], cache["offsets"])
+        return self._corpus
+
+    def useShard(self, shard, numShards):
+        """ Restrict the corpus to one of numShards contiguous ranges of
+        sentences, for a worker process that trains on its own part of
+        the data. Tokens and sampling tables stay those of the full
+        corpus. Shards are always cut from the full corpus, so a
+        process may switch to another shard by calling this again.
+        """
+        if not hasattr(self, "_fullCorpus"):
+            self._fullCorpus = self.corpus()
+        ids, offsets = self._fullCorpus
+        edges = np.linspace(0, offsets.shape[0] - 1, numShards + 1).astype(int)
+        lo, hi = edges[shard], edges[shard + 1]
+        self._corpus = (ids[offsets[lo]:offsets[hi]], offsets[lo:hi + 1] - offsets[lo])
+        if hasattr(self, "_epoch"):
+            del self._epoch
+
+    def subsampleCorpus(self):
+        """ Draw a new frequent-word subsampling of the corpus
+
+        Each token is dropped with probability rejectProb() of its word,
+        and sentences left with fewer than two tokens are dropped. The
+        result is used by getRandomContexts until the next call.
+
+        Return:
+        ids, offsets -- the subsampled corpus, as for corpus()
+        """
+        ids, offsets = self.corpus()
+        rejectProb = self.rejectProb()[ids]
+        keep = (rejectProb <= 0) | (np.random.random(ids.shape[0]) >= rejectProb)
+
+        # Kept tokens per sentence, then only sentences with 2+ tokens
+        kept = np.concatenate(([0], np.cumsum(keep)))[offsets]
+        lengths = np.diff(kept)
+        longEnough = np.repeat(lengths > 1, np.diff(offsets))
+
+        epochIds = ids[keep & longEnough]
+        epochOffsets = np.concatenate(([0], np.cumsum(lengths[lengths > 1])))
+        self._epoch = (epochIds, epochOffsets)
+        self._epochDraws = 0
+        return self._epoch
+
+    def getRandomContexts(self, C):
+        """ Draw a batch of center words and their contexts
+
+        A new subsampling of the corpus is drawn after every
+        numSentences() draws, so that, as with the 30 independently
+        subsampled copies of the corpus used before, contexts do not
+        all come from a single subsampling.
+
+        Arguments:
+        C -- integer array of shape (B,) of context sizes
+
+        Return:
+        centers -- int array of shape (B,) of center word ids
+        contexts -- int array of shape (B, 2 * max(C)) of context ids
+        mask -- boolean array of the same shape, True where contexts
+                holds a context word; contexts never equal the center
+        """
+        C = np.asarray(C)
+        if (not hasattr(self, "_epoch") or
+                self._epochDraws >= self.numSentences()):
+            self.subsampleCorpus()
+        ids, offsets = self._epoch
+        self._epochDraws += C.shape[0]
+
+        maxC = int(C.max())
+        shift = np.concatenate((np.arange(-maxC, 0), np.arange(1, maxC + 1)))
+        centers = np.zeros(C.shape[0], dtype=ids.dtype)
+        contexts = np.zeros((C.shape[0], 2 * maxC), dtype=ids.dtype)
+        mask = np.zeros((C.shape[0], 2 * maxC), dtype=bool)
+
+        # Redraw the rows that end up without any context word
+        todo = np.arange(C.shape[0])
+        while todo.shape[0] > 0:
+            sent = np.random.randint(0, offsets.shape[0] - 1, size=todo.shape[0])
+            start, length = offsets[sent], offsets[sent + 1] - offsets[sent]
+            word = (np.random.random(todo.shape[0]) * length).astype(np.int64)
+
+            pos = word[:, None] + shift
+            valid = ((np.abs(shift) <= C[todo, None]) & (pos >= 0) &
+                     (pos < length[:, None]))
+            ctx = ids[start[:, None] + np.clip(pos, 0, length[:, None] - 1)]
+            center = ids[start + word]
+            valid &= (ctx != center[:, None])
+
+            centers[todo], contexts[todo], mask[todo] = center, ctx, valid
+            todo = todo[~valid.any(axis=1)]
+
+        return centers, contexts, mask
 
     def getRandomContext(self, C=5):
-        allsent = self.allSentences()
-        sentID = random.randint(0, len(allsent) - 1)
-        sent = allsent[sentID]
-        wordID = random.randint(0, len(sent) - 1)
-
-        context = sent[max(0, wordID - C):wordID]
-        if wordID+1 < len(sent):
-            context += sent[wordID+1:min(len(sent), wordID + C + 1)]
-
-        centerword = sent[wordID]
-        context = [w for w in context if w != centerword]
-
-        if len(context) > 0:
-            return centerword, context
-        else:
-            return self.getRandomContext(C)
+        centers, contexts, mask = self.getRandomContexts(np.array([C]))
+        centerword = self._revtokens[centers[0]]
+        context = [self._revtokens[i] for i in contexts[0][mask[0]]]
+        return centerword, context
 
     def sent_labels(self):
         if hasattr(self, "_sent_labels") and self._sent_labels:
             return self._sent_labels
 
+        self._sent_labels = self._cache()["labels"].tolist()
+        return self._sent_labels
+
+    def _parseLabels(self, sentences):
         dictionary = dict()
         phrases = 0
         with open(self.path + "/dictionary.txt", "r") as f:
@@ -137,20 +276,22 @@ class StanfordSentiment:
                 splitted = line.split("|")
                 labels[int(splitted[0])] = float(splitted[1])
 
-        sent_labels = [0.0] * self.numSentences()
-        sentences = self.sentences()
-        for i in xrange(self.numSentences()):
+        sent_labels = [0.0] * len(sentences)
+        for i in xrange(len(sentences)):
             sentence = sentences[i]
             full_sent = " ".join(sentence).replace('-lrb-', '(').replace('-rrb-', ')')
             sent_labels[i] = labels[dictionary[full_sent]]
-
-        self._sent_labels = sent_labels
-        return self._sent_labels
+        return sent_labels
 
     def dataset_split(self):
         if hasattr(self, "_split") and self._split:
             return self._split
 
+        split = self._cache()["split"]
+        self._split = [np.flatnonzero(split == i).tolist() for i in xrange(3)]
+        return self._split
+
+    def _parseSplit(self):
         split = [[] for i in xrange(3)]
         with open(self.path + "/datasetSplit.txt", "r") as f:
             first = True
@@ -161,9 +302,7 @@ class StanfordSentiment:
 
                 splitted = line.strip().split(",")
                 split[int(splitted[1]) - 1] += [int(splitted[0]) - 1]
-
-        self._split = split
-        return self._split
+        return split
 
     def getRandomTrainSentence(self):
         split = self.dataset_split()
@@ -196,53 +335,47 @@ class StanfordSentiment:
         return [(self.sentences()[i], self.categorify(self.sent_labels()[i])) for i in ds_split[split]]
 
     def sampleTable(self):
+        """ Table of token ids for negative sampling
+
+        Each token fills a share of the tablesize entries proportional
+        to its frequency ** 0.75, so a uniformly random entry is a draw
+        from the reweighed unigram distribution. Stored as int32.
+        """
         if hasattr(self, '_sampleTable') and self._sampleTable is not None:
             return self._sampleTable
 
-        nTokens = len(self.tokens())
-        samplingFreq = np.zeros((nTokens,))
-        self.allSentences()
-        i = 0
-        for w in xrange(nTokens):
-            w = self._revtokens[i]
-            if w in self._tokenfreq:
-                freq = 1.0 * self._tokenfreq[w]
-                # Reweigh
-                freq = freq ** 0.75
-            else:
-                freq = 0.0
-            samplingFreq[i] = freq
-            i += 1
+        self.tokens()
+        samplingFreq = np.array([self._tokenfreq.get(w, 0.0)
+                                 for w in self._revtokens], dtype=np.float64)
+        # Reweigh
+        samplingFreq = samplingFreq ** 0.75
 
         samplingFreq /= np.sum(samplingFreq)
         samplingFreq = np.cumsum(samplingFreq) * self.tablesize
 
-        self._sampleTable = [0] * self.tablesize
-
-        j = 0
-        for i in xrange(self.tablesize):
-            while i > samplingFreq[j]:
-                j += 1
-            self._sampleTable[i] = j
-
+        # Entry i holds the first token whose cumulative share reaches i
+        self._sampleTable = np.searchsorted(
+            samplingFreq, np.arange(self.tablesize), side='left').astype(np.int32)
         return self._sampleTable
 
     def rejectProb(self):
         if hasattr(self, '_rejectProb') and self._rejectProb is not None:
             return self._rejectProb
 
+        self.tokens()
         threshold = 1e-5 * self._wordcount
 
-        nTokens = len(self.tokens())
-        rejectProb = np.zeros((nTokens,))
-        for i in xrange(nTokens):
-            w = self._revtokens[i]
-            freq = 1.0 * self._tokenfreq[w]
-            # Reweigh
-            rejectProb[i] = max(0, 1 - np.sqrt(threshold / freq))
+        freq = np.array([self._tokenfreq[w] for w in self._revtokens],
+                        dtype=np.float64)
+        # Reweigh
+        rejectProb = np.maximum(0, 1 - np.sqrt(threshold / freq))
 
         self._rejectProb = rejectProb
         return self._rejectProb
 
     def sampleTokenIdx(self):
-        return self.sampleTable()[random.randint(0, self.tablesize - 1)]
\ No newline at end of file
+        return self.sampleTable()[random.randint(0, self.tablesize - 1)]
+
+    def sampleTokenIdxs(self, size):
+        """ Draw an array of the given shape of sampleTokenIdx samples """
+        return self.sampleTable()[np.random.randint(0, self.tablesize, size=size)]
@@ -0,0 +1,259 @@
+import numpy as np
+
+"""
+Approximate nearest neighbor indices for KNearestNeighbor.
+
+Each index is built once from the training data and then answers top-k
+queries by only scanning a small candidate set:
+
+- IVFIndex clusters PCA-reduced vectors with k-means and scans the points in
+  the num_probes clusters closest to each query.
+- LSHIndex hashes PCA-reduced vectors with random hyperplanes into several
+  tables and scans the points sharing a bucket with the query.
+
+num_probes is the recall-vs-speed knob of both; it can be changed after the
+index has been built. Candidates are ranked by exact L2 distance in the
+original space, so only recall, not the returned distances, is approximate.
+After set_storage the stored points are quantized codes, and distances are
+to the decoded points instead.
+"""
+
+
+class PCA(object):
+  """ Linear projection onto the top principal components of the data """
+
+  def __init__(self, num_components):
+    self.num_components = num_components
+    self.mean = None
+    self.components = None
+
+  def fit(self, X, max_samples=20000):
+    """
+    Inputs:
+    - X: A numpy array of shape (N, D).
+    - max_samples: Fit on a random subset of at most this many rows.
+    """
+    if X.shape[0] > max_samples:
+      X = X[np.random.choice(X.shape[0], max_samples, replace=False)]
+    self.mean = X.mean(axis=0)
+    _, _, Vt = np.linalg.svd(X - self.mean, full_matrices=False)
+    self.components = Vt[:self.num_components].T  # (D, d)
+    return self
+
+  def transform(self, X):
+    return (X - self.mean).dot(self.components)
+
+
+def kmeans(X, num_clusters, num_iters=10, block_size=4096):
+  """
+  Lloyd's algorithm, initialised with randomly chosen data points.
+
+  Inputs:
+  - X: A numpy array of shape (N, d).
+  - num_clusters: Number of clusters K.
+  - num_iters: Number of assignment / update rounds.
+
+  Returns a tuple of:
+  - centroids: Array of shape (K, d)
+  - assignments: Integer array of shape (N,) of cluster indices
+  """
+  N = X.shape[0]
+  num_clusters = min(num_clusters, N)
+  centroids = X[np.random.choice(N, num_clusters, replace=False)].copy()
+  assignments = np.zeros(N, dtype=np.intp)
+  for _ in xrange(num_iters):
+    assignments = nearest_centroids(X, centroids, 1, block_size)[:, 0]
+    counts = np.bincount(assignments, minlength=num_clusters)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assignments, X)
+    nonempty = counts > 0
+    centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    # Restart empty clusters at random points
+    empty = np.flatnonzero(~nonempty)
+    if empty.shape[0] > 0:
+      centroids[empty] = X[np.random.choice(N, empty.shape[0], replace=False)]
+  return centroids, assignments
+
+
+def nearest_centroids(X, centroids, num_nearest, block_size=4096):
+  """
+  Indices of the num_nearest closest centroids to each row of X, closest first.
+  """
+  num_nearest = min(num_nearest, centroids.shape[0])
+  c_sq = np.sum(np.square(centroids), axis=1)
+  out = np.empty((X.shape[0], num_nearest), dtype=np.intp)
+  for i in xrange(0, X.shape[0], block_size):
+    d = c_sq - 2 * X[i:i + block_size].dot(centroids.T)
+    if num_nearest < d.shape[1]:
+      part = np.argpartition(d, num_nearest - 1, axis=1)[:, :num_nearest]
+    else:
+      part = np.tile(np.arange(d.shape[1]), (d.shape[0], 1))
+    rows = np.arange(d.shape[0])[:, None]
+    order = np.argsort(d[rows, part], axis=1)
+    out[i:i + block_size] = part[rows, order]
+  return out
+
+
+class _Index(object):
+  """ Shared query logic: rank candidate sets by exact L2 distance """
+
+  offset = None
+  scale = None
+
+  def build(self, X):
+    raise NotImplementedError
+
+  def set_storage(self, codes, offset, scale, sq_norms):
+    """
+    Rank candidates against quantized training points instead of the X
+    given to build, which is no longer referenced. Point j decodes to
+    codes[j] * scale + offset.
+
+    Inputs:
+    - codes: Array of shape (N, D), e.g. uint8 or float16.
+    - offset, scale: Arrays of shape (D,).
+    - sq_norms: Array of shape (N,) of squared norms of codes * scale.
+    """
+    self.X = codes
+    self.offset = offset
+    self.scale = scale
+    self.sq_norms = sq_norms
+    return self
+
+  def candidates(self, X):
+    """
+    Return a list with one integer array of candidate training indices per
+    row of X.
+    """
+    raise NotImplementedError
+
+  def query(self, X, k=1):
+    """
+    Approximate k nearest neighbors of each row of X.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D).
+    - k: Number of neighbors.
+
+    Returns a tuple of:
+    - dists: Array of shape (num_test, k) of squared L2 distances, sorted.
+    - neighbors: Integer array of shape (num_test, k) of training indices.
+    """
+    num_test = X.shape[0]
+    k = min(k, self.X.shape[0])
+    dists = np.empty((num_test, k))
+    neighbors = np.empty((num_test, k), dtype=np.intp)
+    for i, cand in enumerate(self.candidates(X)):
+      if cand.shape[0] < k:
+        cand = np.arange(self.X.shape[0])  # too few candidates; scan all
+      q = X[i] if self.offset is None else X[i] - self.offset
+      w = q if self.scale is None else q * self.scale
+      d = self.sq_norms[cand] - 2 * self.X[cand].dot(w) + q.dot(q)
+      if k < d.shape[0]:
+        part = np.argpartition(d, k - 1)[:k]
+      else:
+        part = np.arange(d.shape[0])
+      part = part[np.argsort(d[part])]
+      dists[i] = d[part]
+      neighbors[i] = cand[part]
+    return dists, neighbors
+
+
+class IVFIndex(_Index):
+  """
+  Inverted file index: a k-means coarse quantiser over PCA-reduced vectors,
+  with the training points of each cluster stored contiguously.
+  """
+
+  def __init__(self, num_lists=64, num_probes=4, pca_dim=64, num_iters=10):
+    """
+    Inputs:
+    - num_lists: Number of k-means clusters (inverted lists).
+    - num_probes: Number of closest lists scanned per query.
+    - pca_dim: Dimension of the PCA-reduced space used for clustering, or
+      None to cluster the raw vectors.
+    - num_iters: Number of k-means iterations.
+    """
+    self.num_lists = num_lists
+    self.num_probes = num_probes
+    self.pca_dim = pca_dim
+    self.num_iters = num_iters
+
+  def build(self, X):
+    self.X = X
+    self.sq_norms = np.sum(np.square(X), axis=1)
+    self.pca = PCA(self.pca_dim).fit(X) if self.pca_dim else None
+    Z = self._reduce(X)
+    self.centroids, assignments = kmeans(Z, self.num_lists, self.num_iters)
+    self.order = np.argsort(assignments, kind='mergesort')
+    counts = np.bincount(assignments, minlength=self.centroids.shape[0])
+    self.offsets = np.concatenate(([0], np.cumsum(counts)))
+    return self
+
+  def _reduce(self, X):
+    return self.pca.transform(X) if self.pca is not None else X
+
+  def candidates(self, X):
+    probes = nearest_centroids(self._reduce(X), self.centroids, self.num_probes)
+    out = []
+    for lists in probes:
+      out.append(np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]]
+                                 for l in lists]))
+    return out
+
+
+class LSHIndex(_Index):
+  """
+  Random-projection LSH over PCA-reduced, mean-centered vectors. Each of
+  num_tables tables hashes points to num_bits sign bits; num_probes buckets
+  are scanned per table, starting with the query's own bucket and then
+  flipping the bits whose projections are closest to zero.
+  """
+
+  def __init__(self, num_tables=8, num_bits=12, num_probes=1, pca_dim=64):
+    self.num_tables = num_tables
+    self.num_bits = num_bits
+    self.num_probes = num_probes
+    self.pca_dim = pca_dim
+
+  def build(self, X):
+    self.X = X
+    self.sq_norms = np.sum(np.square(X), axis=1)
+    self.pca = PCA(self.pca_dim).fit(X) if self.pca_dim else None
+    self.mean = X.mean(axis=0)
+    Z = self._reduce(X)
+    self.planes = np.random.randn(self.num_tables, Z.shape[1], self.num_bits)
+    self.powers = 2 ** np.arange(self.num_bits)
+
+    self.tables = []
+    for t in xrange(self.num_tables):
+      codes = (Z.dot(self.planes[t]) > 0).dot(self.powers)
+      order = np.argsort(codes, kind='mergesort')
+      self.tables.append((codes[order], order))
+    return self
+
+  def _reduce(self, X):
+    if self.pca is not None:
+      return self.pca.transform(X)
+    return X - self.mean
+
+  def candidates(self, X):
+    Z = self._reduce(X)
+    num_flips = min(self.num_probes - 1, self.num_bits)
+    per_query = [[] for _ in xrange(X.shape[0])]
+    for t, (codes, order) in enumerate(self.tables):
+      proj = Z.dot(self.planes[t])  # (num_test, num_bits)
+      base = (proj > 0).dot(self.powers)
+      probes = [base]
+      if num_flips > 0:
+        flip_bits = np.argsort(np.abs(proj), axis=1)[:, :num_flips]
+        for j in xrange(num_flips):
+          probes.append(base ^ self.powers[flip_bits[:, j]])
+      for code in probes:
+        lo = np.searchsorted(codes, code, side='left')
+        hi = np.searchsorted(codes, code, side='right')
+        for i in xrange(X.shape[0]):
+          if hi[i] > lo[i]:
+            per_query[i].append(order[lo[i]:hi[i]])
+    return [np.unique(np.concatenate(c)) if c else np.zeros(0, dtype=np.intp)
+            for c in per_query]
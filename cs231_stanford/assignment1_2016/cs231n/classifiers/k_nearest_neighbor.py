@@ -1,26 +1,84 @@
+import time
 import numpy as np
-from collections import Counter
 
 class KNearestNeighbor(object):
   """ a kNN classifier with L2 distance """
 
-  def __init__(self):
-    pass
+  def __init__(self, max_memory=256 * 2 ** 20, storage='float64'):
+    """
+    Inputs:
+    - max_memory: Approximate upper bound in bytes on the temporary distance
+      blocks allocated by compute_neighbors (and so by predict with
+      num_loops=0).
+    - storage: How the training data is held in memory. 'float64' keeps X as
+      given. 'uint8' and 'float16' store it quantized with a per-dimension
+      offset and scale (8x / 4x smaller than float64), and compute_neighbors
+      then computes distances in float32.
+    """
+    if storage not in ('float64', 'float16', 'uint8'):
+      raise ValueError('Invalid storage "%s"' % storage)
+    self.max_memory = max_memory
+    self.storage = storage
 
-  def train(self, X, y):
+  def train(self, X, y, index=None):
     """
     Train the classifier. For k-nearest neighbors this is just 
-    memorizing the training data.
+    memorizing the training data, and optionally building an approximate
+    nearest neighbor index over it.
 
     Inputs:
     - X: A numpy array of shape (num_train, D) containing the training data
       consisting of num_train samples each of dimension D.
     - y: A numpy array of shape (N,) containing the training labels, where
          y[i] is the label for X[i].
+    - index: Optional unbuilt index from cs231n.ann_index (e.g. IVFIndex() or
+      LSHIndex()). If given, predict with num_loops=0 queries the index
+      instead of scanning all of X_train. With quantized storage the index
+      ranks its candidates against the stored codes, so it does not keep a
+      full-precision copy of X either.
     """
-    self.X_train = X
+    self.index = index
     self.y_train = y
-    
+    if self.storage == 'float64':
+      self.train_data = X
+      self.offset, self.scale = None, None
+      self.train_sq_norms = np.sum(np.square(X), axis=1)
+      if index is not None:
+        index.build(X)
+      return
+
+    X = np.asarray(X, dtype=np.float32)
+    if self.storage == 'uint8':
+      lo, hi = X.min(axis=0), X.max(axis=0)
+      self.offset = lo
+      self.scale = np.where(hi > lo, (hi - lo) / 255, 1).astype(np.float32)
+      codes = np.empty(X.shape, dtype=np.uint8)
+      for j in xrange(0, X.shape[0], 4096):
+        codes[j:j + 4096] = np.rint((X[j:j + 4096] - lo) / self.scale)
+    else:
+      self.offset = X.mean(axis=0)
+      std = X.std(axis=0)
+      self.scale = np.where(std > 0, std, 1).astype(np.float32)
+      codes = ((X - self.offset) / self.scale).astype(np.float16)
+    self.train_data = codes
+    # Norms of the stored points, relative to the offset, computed once here
+    self.train_sq_norms = np.empty(X.shape[0], dtype=np.float32)
+    for j in xrange(0, X.shape[0], 4096):
+      block = codes[j:j + 4096].astype(np.float32) * self.scale
+      self.train_sq_norms[j:j + 4096] = np.sum(np.square(block), axis=1)
+    if index is not None:
+      index.build(X).set_storage(codes, self.offset, self.scale,
+                                 self.train_sq_norms)
+
+  @property
+  def X_train(self):
+    """
+    The training data as floats; decoded on access for quantized storage.
+    """
+    if self.storage == 'float64':
+      return self.train_data
+    return self.train_data.astype(np.float32) * self.scale + self.offset
+
   def predict(self, X, k=1, num_loops=0):
     """
     Predict labels for test data using this classifier.
@@ -37,7 +95,11 @@ class KNearestNeighbor(object):
       test data, where y[i] is the predicted label for the test point X[i].  
     """
     if num_loops == 0:
-      dists = self.compute_distances_no_loops(X)
+      if self.index is not None:
+        _, neighbors = self.index.query(X, k=k)
+      else:
+        _, neighbors = self.compute_neighbors(X, k=k)
+      return self.vote_labels(neighbors)
     elif num_loops == 1:
       dists = self.compute_distances_one_loop(X)
     elif num_loops == 2:
@@ -61,8 +123,9 @@ class KNearestNeighbor(object):
       is the Euclidean distance between the ith test point and the jth training
       point.
     """
+    X_train = self.X_train
     num_test = X.shape[0]
-    num_train = self.X_train.shape[0]
+    num_train = X_train.shape[0]
     dists = np.zeros((num_test, num_train))
     for i in xrange(num_test):
       for j in xrange(num_train):
@@ -74,7 +137,7 @@ class KNearestNeighbor(object):
         #####################################################################
         #  dists[i, j] = X[i,:].dot(self.X_train[j,:]) # dot product
         #  X_sqr = X[i,:] * X[i,:].T
-        dists[i,j] = np.sum(np.square(X[i,:] - self.X_train[j,:]))
+        dists[i,j] = np.sum(np.square(X[i,:] - X_train[j,:]))
         #  X_train_sqr = X_train[j,:] * 
         #####################################################################
         #                       END OF YOUR CODE                            #
@@ -88,8 +151,9 @@ class KNearestNeighbor(object):
 
     Input / Output: Same as compute_distances_two_loops
     """
+    X_train = self.X_train
     num_test = X.shape[0]
-    num_train = self.X_train.shape[0]
+    num_train = X_train.shape[0]
     dists = np.zeros((num_test, num_train))
     for i in xrange(num_test):
       #######################################################################
@@ -97,8 +161,8 @@ class KNearestNeighbor(object):
       # Compute the l2 distance between the ith test point and all training #
       # points, and store the result in dists[i, :].                        #
       #######################################################################
-      diff_sqr = np.square(X[i,:] - self.X_train) # (num_train x features)
-      sum_row = diff_sqr.dot(np.ones(self.X_train.shape[1])) # (num_train x 1)
+      diff_sqr = np.square(X[i,:] - X_train) # (num_train x features)
+      sum_row = diff_sqr.dot(np.ones(X_train.shape[1])) # (num_train x 1)
       dists[i,:] = sum_row
       #######################################################################
       #                         END OF YOUR CODE                            #
@@ -112,8 +176,9 @@ class KNearestNeighbor(object):
 
     Input / Output: Same as compute_distances_two_loops
     """
+    X_train = self.X_train
     num_test = X.shape[0]
-    num_train = self.X_train.shape[0]
+    num_train = X_train.shape[0]
     dists = np.zeros((num_test, num_train)) 
     #########################################################################
     # TODO:                                                                 #
@@ -128,8 +193,8 @@ class KNearestNeighbor(object):
     #       and two broadcast sums.                                         #
     #########################################################################
     test_sum = np.sum(np.square(X), axis=1)
-    train_sum = np.sum(np.square(self.X_train), axis=1)
-    inner_product = np.dot(X, self.X_train.T)
+    train_sum = np.sum(np.square(X_train), axis=1)
+    inner_product = np.dot(X, X_train.T)
     dists = -2 * inner_product + test_sum.reshape(-1,1) + train_sum
     #########################################################################
     #                         END OF YOUR CODE                              #
@@ -149,33 +214,134 @@ class KNearestNeighbor(object):
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in xrange(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-      #########################################################################
-      # TODO:                                                                 #
-      # Use the distance matrix to find the k nearest neighbors of the ith    #
-      # testing point, and use self.y_train to find the labels of these       #
-      # neighbors. Store these labels in closest_y.                           #
-      # Hint: Look up the function numpy.argsort.                             #
-      #########################################################################
-      y_train_idx = np.argsort(dists[i,:])
-      closest_y = self.y_train[y_train_idx[:k]]
-      #########################################################################
-      # TODO:                                                                 #
-      # Now that you have found the labels of the k nearest neighbors, you    #
-      # need to find the most common label in the list closest_y of labels.   #
-      # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-      # label.                                                                #
-      #########################################################################
-      c = Counter(closest_y)
-      y_pred[i] = c.most_common()[0][0]
-      #########################################################################
-      #                           END OF YOUR CODE                            # 
-      #########################################################################
-
-    return y_pred
+    k = min(k, dists.shape[1])
+    neighbors = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    return self.vote_labels(neighbors)
+
+  def vote_labels(self, neighbors):
+    """
+    Majority vote over the labels of each test point's neighbors, breaking
+    ties by choosing the smaller label.
+
+    Inputs:
+    - neighbors: Integer array of shape (num_test, k) of indices into
+      self.X_train.
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels.
+    """
+    num_test, k = neighbors.shape
+    closest_y = self.y_train[neighbors]  # (num_test, k)
+    num_classes = np.max(self.y_train) + 1
+    offsets = np.arange(num_test)[:, None] * num_classes
+    votes = np.bincount((closest_y + offsets).ravel(),
+                        minlength=num_test * num_classes)
+    votes = votes.reshape(num_test, num_classes)
+    return np.argmax(votes, axis=1)  # argmax returns the first (smallest) tie
+
+  def compute_neighbors(self, X, k=1, max_memory=None):
+    """
+    Find the k nearest training points of each test point without
+    materialising the full (num_test, num_train) distance matrix.
+
+    Test and training points are streamed through the distance GEMM in
+    blocks; after each training block the running top-k of every test point is
+    merged with the new distances using np.argpartition.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: Number of neighbors to return.
+    - max_memory: Approximate bound in bytes on the temporary blocks; defaults
+      to self.max_memory.
+
+    Returns a tuple of:
+    - dists: Array of shape (num_test, k) of squared L2 distances to the
+      neighbors, sorted in increasing order.
+    - neighbors: Integer array of shape (num_test, k) of indices into
+      self.X_train, parallel to dists.
+    """
+    if max_memory is None:
+      max_memory = self.max_memory
+    num_test = X.shape[0]
+    num_train = self.train_data.shape[0]
+    k = min(k, num_train)
+    test_block, train_block = self._block_sizes(num_test, num_train, k, max_memory)
+
+    best_dists = np.empty((num_test, k))
+    best_idx = np.empty((num_test, k), dtype=np.intp)
+    for i in xrange(0, num_test, test_block):
+      X_block = X[i:i + test_block]
+      if self.storage != 'float64':
+        # ||x - (o + s * q)||^2 = ||x - o||^2 - 2 (s * (x - o)) . q + ||s * q||^2
+        X_block = (X_block - self.offset).astype(np.float32)
+        test_sq = np.sum(np.square(X_block), axis=1)[:, None]
+        X_block *= self.scale
+      else:
+        test_sq = np.sum(np.square(X_block), axis=1)[:, None]
+      run_dists = np.empty((X_block.shape[0], 0), dtype=X_block.dtype)
+      run_idx = np.empty((X_block.shape[0], 0), dtype=np.intp)
+      for j in xrange(0, num_train, train_block):
+        train_block_data = self.train_data[j:j + train_block]
+        if self.storage != 'float64':
+          train_block_data = train_block_data.astype(np.float32)
+        dists = -2 * X_block.dot(train_block_data.T)
+        dists += test_sq
+        dists += self.train_sq_norms[j:j + train_block]
+        idx = np.arange(j, j + dists.shape[1])
+
+        cand_dists = np.hstack((run_dists, dists))
+        cand_idx = np.hstack((run_idx, np.broadcast_to(idx, dists.shape)))
+        if cand_dists.shape[1] > k:
+          part = np.argpartition(cand_dists, k - 1, axis=1)[:, :k]
+          rows = np.arange(cand_dists.shape[0])[:, None]
+          cand_dists, cand_idx = cand_dists[rows, part], cand_idx[rows, part]
+        run_dists, run_idx = cand_dists, cand_idx
+
+      order = np.argsort(run_dists, axis=1)
+      rows = np.arange(run_dists.shape[0])[:, None]
+      best_dists[i:i + test_block] = run_dists[rows, order]
+      best_idx[i:i + test_block] = run_idx[rows, order]
+
+    return best_dists, best_idx
+
+  def measure_index(self, X, k=10):
+    """
+    Compare the approximate index against the exact blocked scan.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) of query points.
+    - k: Number of neighbors to retrieve.
+
+    Returns a dictionary with:
+    - recall: Fraction of the exact k nearest neighbors found by the index.
+    - exact_time, index_time: Seconds spent per query by each path.
+    """
+    if self.index is None:
+      raise ValueError('No index was built; pass index= to train')
+    start = time.time()
+    _, exact = self.compute_neighbors(X, k=k)
+    exact_time = time.time() - start
+    start = time.time()
+    _, approx = self.index.query(X, k=k)
+    index_time = time.time() - start
+
+    found = 0
+    for e, a in zip(exact, approx):
+      found += np.intersect1d(e, a).shape[0]
+    return {
+      'recall': found / float(exact.size),
+      'exact_time': exact_time / X.shape[0],
+      'index_time': index_time / X.shape[0],
+    }
+
+  def _block_sizes(self, num_test, num_train, k, max_memory):
+    """
+    Pick test and train block sizes so that a distance block together with the
+    candidates merged into the running top-k fits in max_memory bytes.
+    """
+    # distances, merged distances and merged indices: ~3 arrays of 8 bytes
+    max_elems = max(1, max_memory // 24)
+    test_block = max(1, min(num_test, 256, max_elems // (2 * k)))
+    train_block = max(1, min(num_train, max_elems // test_block - k))
+    return test_block, train_block
 
@@ -1,20 +1,60 @@
 import numpy as np
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
+from cs231n.classifiers.parallel import ShardedLoss, hogwild_train
+
+def _iter_chunks(X, chunk_size):
+  """
+  Yield consecutive row blocks of X. Arrays, memmaps and sparse matrices are
+  sliced into chunk_size rows; any other iterable is assumed to already yield
+  row blocks.
+  """
+  if hasattr(X, 'shape'):
+    for i in xrange(0, X.shape[0], chunk_size):
+      yield X[i:i + chunk_size]
+  else:
+    for X_chunk in X:
+      yield X_chunk
+
+
+def _labeled_chunks(X, y, chunk_size):
+  """
+  Yield (X_chunk, y_chunk) pairs, slicing y by the actual number of rows of
+  each chunk so that the blocks of an iterable X stay aligned with y.
+  """
+  start = 0
+  for X_chunk in _iter_chunks(X, chunk_size):
+    stop = start + X_chunk.shape[0]
+    yield X_chunk, y[start:stop]
+    start = stop
+  if start != y.shape[0]:
+    raise ValueError('X has %d rows but y has %d labels' % (start, y.shape[0]))
+
+
+def _concatenate(parts, dtype, empty_shape=(0,)):
+  if not parts:
+    return np.zeros(empty_shape, dtype=dtype)
+  return np.concatenate(parts)
+
 
 class LinearClassifier(object):
 
+  # Module-level loss function loss_fn(W, X, y, reg) used by the worker
+  # processes when training with num_workers > 1. Subclasses set this.
+  loss_fn = None
+
   def __init__(self):
     self.W = None
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, solver='sgd', num_workers=None):
     """
-    Train this linear classifier using stochastic gradient descent.
+    Train this linear classifier using stochastic gradient descent, or one of
+    the alternative solvers.
 
     Inputs:
-    - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+    - X: A numpy array or scipy.sparse CSR matrix of shape (N, D) containing
+      training data; there are N training samples each of dimension D.
     - y: A numpy array of shape (N,) containing training labels; y[i] = c
       means that X[i] has label 0 <= c < C for C classes.
     - learning_rate: (float) learning rate for optimization.
@@ -22,6 +62,20 @@ class LinearClassifier(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - solver: (string) One of:
+      - 'sgd': minibatch SGD with a fixed learning rate, num_iters steps.
+      - 'lbfgs': full-batch L-BFGS with a strong Wolfe line search; num_iters
+        is the maximum number of iterations and learning_rate and batch_size
+        are unused. For large-batch training pass a subsample of X.
+      - 'svrg': stochastic variance-reduced gradient; num_iters is the number
+        of epochs, each computing one full gradient and then taking
+        num_train / batch_size minibatch steps of size learning_rate.
+      - 'hogwild': asynchronous minibatch SGD by num_workers processes, each
+        on its own shard of the data, updating a shared-memory W without
+        locks; num_iters steps in total.
+    - num_workers: (integer) If greater than 1, split the data into this many
+      shards, one per worker process. For 'sgd', 'lbfgs' and 'svrg' the
+      full-batch and minibatch gradients are computed per shard and reduced.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
@@ -32,6 +86,40 @@ class LinearClassifier(object):
       # lazily initialize W
       self.W = 0.001 * np.random.randn(dim, num_classes)
 
+    if solver not in ('sgd', 'lbfgs', 'svrg', 'hogwild'):
+      raise ValueError('Invalid solver "%s"' % solver)
+    parallel = num_workers is not None and num_workers > 1
+    if (parallel or solver == 'hogwild') and self.loss_fn is None:
+      raise ValueError('%s does not support multi-process training'
+                       % type(self).__name__)
+
+    if solver == 'hogwild':
+      self.W, loss_history = hogwild_train(
+        type(self).loss_fn, X, y, self.W, learning_rate, reg, num_iters,
+        batch_size, num_workers)
+      return loss_history
+
+    sharded = ShardedLoss(type(self).loss_fn, X, y, num_workers) if parallel else None
+    try:
+      if solver == 'lbfgs':
+        return self._train_lbfgs(X, y, reg, num_iters, verbose, sharded)
+      elif solver == 'svrg':
+        return self._train_svrg(X, y, learning_rate, reg, num_iters, batch_size,
+                                verbose, sharded)
+      return self._train_sgd(X, y, learning_rate, reg, num_iters, batch_size,
+                             verbose, sharded)
+    finally:
+      if sharded is not None:
+        sharded.close()
+
+  def _train_sgd(self, X, y, learning_rate, reg, num_iters, batch_size,
+                 verbose, sharded=None):
+    """
+    Minibatch SGD; with sharded, each minibatch is drawn across the shards
+    by the worker processes, which compute its gradient.
+    """
+    num_train = X.shape[0]
+
     # Run stochastic gradient descent to optimize W
     loss_history = []
     for it in xrange(num_iters):
@@ -49,15 +137,20 @@ class LinearClassifier(object):
       # Hint: Use np.random.choice to generate indices. Sampling with         #
       # replacement is faster than sampling without replacement.              #
       #########################################################################
-      sample = np.random.choice(num_train, size=batch_size, replace=True)
-      X_batch = X[sample]
-      y_batch = y[sample]
+      # With sharded, the workers draw the minibatch from their own shards
+      if sharded is None:
+        sample = np.random.choice(num_train, size=batch_size, replace=True)
+        X_batch = X[sample]
+        y_batch = y[sample]
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
 
       # evaluate loss and gradient
-      loss, grad = self.loss(X_batch, y_batch, reg)
+      if sharded is not None:
+        loss, grad = sharded(self.W, reg, batch_size)
+      else:
+        loss, grad = self.loss(X_batch, y_batch, reg)
       loss_history.append(loss)
 
       # perform parameter update
@@ -75,30 +168,226 @@ class LinearClassifier(object):
 
     return loss_history
 
-  def predict(self, X):
+  def _loss_at(self, W, X, y, reg):
+    """ Evaluate self.loss at weights W, leaving self.W set to W. """
+    self.W = W
+    return self.loss(X, y, reg)
+
+  def _full_loss(self, W, X, y, reg, sharded):
+    """ Loss and gradient over all of X, optionally across the shards. """
+    if sharded is not None:
+      self.W = W
+      return sharded(W, reg)
+    return self._loss_at(W, X, y, reg)
+
+  def _train_lbfgs(self, X, y, reg, num_iters, verbose, sharded=None,
+                   history_size=10, tol=1e-6):
+    """
+    Full-batch L-BFGS on the loss of the whole training set.
+    """
+    W = self.W
+    loss, grad = self._full_loss(W, X, y, reg, sharded)
+    loss_history = [loss]
+    s_hist, y_hist, rho_hist = [], [], []
+    for it in xrange(num_iters):
+      # Two-loop recursion for the search direction
+      q = grad.copy()
+      alphas = []
+      for s_k, y_k, rho_k in reversed(list(zip(s_hist, y_hist, rho_hist))):
+        a = rho_k * np.sum(s_k * q)
+        alphas.append(a)
+        q -= a * y_k
+      if s_hist:
+        q *= np.sum(s_hist[-1] * y_hist[-1]) / np.sum(y_hist[-1] * y_hist[-1])
+      else:
+        q /= max(1.0, np.sqrt(np.sum(grad * grad)))
+      for (s_k, y_k, rho_k), a in zip(zip(s_hist, y_hist, rho_hist), reversed(alphas)):
+        q += s_k * (a - rho_k * np.sum(y_k * q))
+      direction = -q
+
+      step, new_loss, new_grad = self._wolfe_line_search(
+        W, loss, grad, direction, X, y, reg, sharded)
+      if step is None:
+        break
+      s_k = step * direction
+      y_k = new_grad - grad
+      sy = np.sum(s_k * y_k)
+      if sy > 1e-10:
+        s_hist.append(s_k)
+        y_hist.append(y_k)
+        rho_hist.append(1.0 / sy)
+        if len(s_hist) > history_size:
+          s_hist.pop(0)
+          y_hist.pop(0)
+          rho_hist.pop(0)
+
+      W = W + s_k
+      improvement = loss - new_loss
+      loss, grad = new_loss, new_grad
+      loss_history.append(loss)
+      if verbose and it % 10 == 0:
+        print 'iteration %d / %d: loss %f' % (it, num_iters, loss)
+      if improvement <= tol * max(1.0, abs(loss)):
+        break
+
+    self.W = W
+    return loss_history
+
+  def _wolfe_line_search(self, W, loss, grad, direction, X, y, reg,
+                         sharded=None, c1=1e-4, c2=0.9, max_evals=20):
+    """
+    Find a step size along direction satisfying the strong Wolfe conditions
+    (bracketing and zoom, as in Nocedal & Wright, Algorithm 3.5).
+
+    Returns a tuple (step, loss, grad) at the accepted point, or
+    (None, None, None) if direction is not a descent direction or no step was
+    found.
+    """
+    slope0 = np.sum(grad * direction)
+    if slope0 >= 0:
+      return None, None, None
+
+    def phi(a):
+      f, g = self._full_loss(W + a * direction, X, y, reg, sharded)
+      return f, g, np.sum(g * direction)
+
+    def zoom(lo, f_lo, hi, evals):
+      while evals < max_evals:
+        a = 0.5 * (lo + hi)
+        f, g, slope = phi(a)
+        evals += 1
+        if f > loss + c1 * a * slope0 or f >= f_lo:
+          hi = a
+        else:
+          if abs(slope) <= -c2 * slope0:
+            return a, f, g
+          if slope * (hi - lo) >= 0:
+            hi = lo
+          lo, f_lo = a, f
+      return (lo, f_lo, phi(lo)[1]) \
+        if lo > 0 else (None, None, None)
+
+    prev_a, prev_f = 0.0, loss
+    a = 1.0
+    for evals in xrange(1, max_evals + 1):
+      f, g, slope = phi(a)
+      if f > loss + c1 * a * slope0 or (evals > 1 and f >= prev_f):
+        return zoom(prev_a, prev_f, a, evals)
+      if abs(slope) <= -c2 * slope0:
+        return a, f, g
+      if slope >= 0:
+        return zoom(a, f, prev_a, evals)
+      prev_a, prev_f = a, f
+      a *= 2
+    return None, None, None
+
+  def _train_svrg(self, X, y, learning_rate, reg, num_epochs, batch_size,
+                  verbose, sharded=None):
+    """
+    SVRG: every epoch takes a snapshot of W and its full gradient, and the
+    minibatch steps use the gradient at W corrected by the minibatch gradient
+    at the snapshot, which removes most of the minibatch noise. With sharded,
+    both the full gradient and the minibatch gradients are computed by the
+    workers.
+    """
+    num_train = X.shape[0]
+    steps_per_epoch = max(num_train // batch_size, 1)
+    loss_history = []
+    W = self.W
+    for epoch in xrange(num_epochs):
+      W_snap = W.copy()
+      full_loss, full_grad = self._full_loss(W_snap, X, y, reg, sharded)
+      for it in xrange(steps_per_epoch):
+        if sharded is not None:
+          loss, grad, snap_grad = sharded.pair(W, W_snap, reg, batch_size)
+        else:
+          sample = np.random.choice(num_train, size=batch_size, replace=True)
+          X_batch, y_batch = X[sample], y[sample]
+          _, snap_grad = self._loss_at(W_snap, X_batch, y_batch, reg)
+          loss, grad = self._loss_at(W, X_batch, y_batch, reg)
+        W = W - learning_rate * (grad - snap_grad + full_grad)
+        loss_history.append(loss)
+      if verbose:
+        print 'epoch %d / %d: loss %f' % (epoch, num_epochs, full_loss)
+    self.W = W
+    return loss_history
+
+  def predict(self, X, chunk_size=10000):
     """
     Use the trained weights of this linear classifier to predict labels for
     data points.
 
+    Scores are computed chunk_size rows at a time, so memory use does not grow
+    with the number of points beyond the returned labels.
+
     Inputs:
-    - X: D x N array of training data. Each column is a D-dimensional point.
+    - X: N x D array or scipy.sparse CSR matrix of data. Each row is a
+      D-dimensional point. X may also be a memory-mapped array, or an iterable
+      of such arrays that are treated as consecutive chunks.
+    - chunk_size: Number of rows scored at a time.
 
     Returns:
     - y_pred: Predicted labels for the data in X. y_pred is a 1-dimensional
       array of length N, and each element is an integer giving the predicted
       class.
     """
-    y_pred = np.zeros(X.shape[1])
-    ###########################################################################
-    # TODO:                                                                   #
-    # Implement this method. Store the predicted labels in y_pred.            #
-    ###########################################################################
-    y_pred = np.argmax(X.dot(self.W), axis=1)
-    ###########################################################################
-    #                           END OF YOUR CODE                              #
-    ###########################################################################
-    return y_pred
-  
+    y_pred = [np.argmax(X_chunk.dot(self.W), axis=1)
+              for X_chunk in _iter_chunks(X, chunk_size)]
+    return _concatenate(y_pred, np.intp)
+
+  def predict_top_k(self, X, k=5, chunk_size=10000):
+    """
+    Predict the k highest-scoring labels of each data point.
+
+    Inputs:
+    - X, chunk_size: As for predict.
+    - k: Number of labels per point.
+
+    Returns a tuple of:
+    - labels: Integer array of shape (N, k), best label first.
+    - scores: Array of shape (N, k) of the corresponding scores.
+    """
+    k = min(k, self.W.shape[1])
+    labels, scores = [], []
+    for X_chunk in _iter_chunks(X, chunk_size):
+      s = X_chunk.dot(self.W)
+      top = np.argpartition(-s, k - 1, axis=1)[:, :k]
+      rows = np.arange(s.shape[0])[:, None]
+      order = np.argsort(-s[rows, top], axis=1)
+      labels.append(top[rows, order])
+      scores.append(s[rows, labels[-1]])
+    return (_concatenate(labels, np.intp, (0, k)),
+            _concatenate(scores, self.W.dtype, (0, k)))
+
+  def evaluate(self, X, y=None, chunk_size=10000):
+    """
+    Compute the accuracy and confusion matrix of this classifier, streaming
+    over the data so that only one chunk of scores is held at a time.
+
+    Inputs:
+    - X: Data as for predict, with labels y; if X is an iterable of row
+      blocks, y is consumed in step with them. Alternatively, pass y=None and
+      an iterable of (X_batch, y_batch) tuples as X.
+    - y: Array of shape (N,) of labels, or None.
+    - chunk_size: Number of rows scored at a time.
+
+    Returns a tuple of:
+    - accuracy: Fraction of correctly classified points.
+    - confusion: Integer array of shape (C, C) where confusion[i, j] counts
+      the points of class i that were predicted as class j.
+    """
+    num_classes = self.W.shape[1]
+    batches = X if y is None else _labeled_chunks(X, y, chunk_size)
+    counts = np.zeros(num_classes * num_classes, dtype=np.int64)
+    for X_batch, y_batch in batches:
+      y_pred = self.predict(X_batch, chunk_size)
+      counts += np.bincount(np.asarray(y_batch) * num_classes + y_pred,
+                            minlength=num_classes * num_classes)
+    confusion = counts.reshape(num_classes, num_classes)
+    total = confusion.sum()
+    accuracy = np.trace(confusion) / float(total) if total > 0 else 0.0
+    return accuracy, confusion
+
   def loss(self, X_batch, y_batch, reg):
     """
     Compute the loss function and its derivative. 
@@ -120,6 +409,8 @@ class LinearClassifier(object):
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
 
+  loss_fn = staticmethod(svm_loss_vectorized)
+
   def loss(self, X_batch, y_batch, reg):
     return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
@@ -127,6 +418,8 @@ class LinearSVM(LinearClassifier):
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
 
+  loss_fn = staticmethod(softmax_loss_vectorized)
+
   def loss(self, X_batch, y_batch, reg):
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
 
@@ -65,7 +65,9 @@ def svm_loss_vectorized(W, X, y, reg):
   """
   Structured SVM loss function, vectorized implementation.
 
-  Inputs and outputs are the same as svm_loss_naive.
+  Inputs and outputs are the same as svm_loss_naive, except that X may also be
+  a scipy.sparse CSR matrix. X only enters through sparse-dense products, so
+  it is never densified.
   """
   loss = 0.0
   dW = np.zeros(W.shape) # initialize the gradient as zero
@@ -98,9 +100,10 @@ def svm_loss_vectorized(W, X, y, reg):
   # loss.                                                                     #
   #############################################################################
   num_happen = np.sum(margin > 0, axis=0)
-  dW = X.T.dot((margin > 0).T) - X.T.dot((correct_class_idx * num_happen).T)
+  coeff = (margin > 0).astype(W.dtype) - correct_class_idx * num_happen # (10,500)
+  dW = X.T.dot(coeff.T)
   dW /= X.shape[0]
-  pass
+  dW += reg * W
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -0,0 +1,180 @@
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+"""
+Multi-process training helpers for LinearClassifier.
+
+The training data is handed to the worker processes once, through the pool
+initializer; with the fork start method the workers inherit the parent's
+arrays instead of receiving pickled copies. Per-call messages only carry the
+weights and a shard id.
+"""
+
+_state = {}
+
+
+def _init_worker(loss_fn, X, y, bounds, shared_W=None, W_shape=None):
+  _state['loss_fn'] = loss_fn
+  _state['X'], _state['y'], _state['bounds'] = X, y, bounds
+  if shared_W is not None:
+    _state['W'] = np.frombuffer(shared_W).reshape(W_shape)
+
+
+def _shard_rows(shard, batch_size, seed):
+  lo, hi = _state['bounds'][shard]
+  if batch_size is None:
+    return _state['X'][lo:hi], _state['y'][lo:hi]
+  sample = np.random.RandomState(seed).randint(lo, hi, size=batch_size)
+  return _state['X'][sample], _state['y'][sample]
+
+
+def _shard_loss(task):
+  shard, W, reg, batch_size, seed = task
+  X, y = _shard_rows(shard, batch_size, seed)
+  loss, grad = _state['loss_fn'](W, X, y, reg)
+  return X.shape[0], loss, grad
+
+
+def _shard_loss_pair(task):
+  shard, W, W_snap, reg, batch_size, seed = task
+  X, y = _shard_rows(shard, batch_size, seed)
+  loss, grad = _state['loss_fn'](W, X, y, reg)
+  _, snap_grad = _state['loss_fn'](W_snap, X, y, reg)
+  return X.shape[0], loss, grad, snap_grad
+
+
+def _hogwild_worker(task):
+  shard, learning_rate, reg, num_iters, batch_size, seed = task
+  lo, hi = _state['bounds'][shard]
+  X, y, W = _state['X'], _state['y'], _state['W']
+  rng = np.random.RandomState(seed)
+  losses = []
+  for it in xrange(num_iters):
+    sample = rng.randint(lo, hi, size=batch_size)
+    loss, grad = _state['loss_fn'](W, X[sample], y[sample], reg)
+    # Lock-free update of the shared weights
+    W -= learning_rate * grad
+    losses.append(loss)
+  return losses
+
+
+def shard_bounds(num_train, num_shards):
+  edges = np.linspace(0, num_train, num_shards + 1).astype(int)
+  return list(zip(edges[:-1], edges[1:]))
+
+
+class ShardedLoss(object):
+  """
+  Evaluate a vectorized loss such as svm_loss_vectorized over a data set that
+  is split into one shard per worker process, reducing the partial losses and
+  gradients in the parent.
+
+  Each vectorized loss averages its data term over the rows it sees and adds
+  the regulariser once, so weighting the partial results by shard size gives
+  exactly the loss and gradient over the union of the shards.
+  """
+
+  def __init__(self, loss_fn, X, y, num_workers=None):
+    """
+    Inputs:
+    - loss_fn: A function loss_fn(W, X, y, reg) -> (loss, dW).
+    - X, y: Training data and labels.
+    - num_workers: Number of processes; defaults to the number of CPUs.
+    """
+    if num_workers is None:
+      num_workers = multiprocessing.cpu_count()
+    self.num_workers = num_workers
+    self.bounds = shard_bounds(X.shape[0], num_workers)
+    self.pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                     initargs=(loss_fn, X, y, self.bounds))
+    self._calls = 0
+
+  def __call__(self, W, reg, batch_size=None):
+    """
+    Inputs:
+    - W: Weights of shape (D, C).
+    - reg: Regularization strength.
+    - batch_size: If None, use every row of every shard. Otherwise each shard
+      samples about batch_size / num_workers rows (with replacement).
+
+    Returns a tuple of:
+    - loss: Scalar loss
+    - dW: Gradient with respect to W
+    """
+    if batch_size is not None:
+      batch_size = max(1, batch_size // self.num_workers)
+    self._calls += 1
+    tasks = [(i, W, reg, batch_size, self._calls * self.num_workers + i)
+             for i in xrange(self.num_workers)]
+    results = self.pool.map(_shard_loss, tasks)
+    total = float(sum(n for n, _, _ in results))
+    loss = sum(n / total * l for n, l, _ in results)
+    grad = sum(n / total * g for n, _, g in results)
+    return loss, grad
+
+  def pair(self, W, W_snap, reg, batch_size):
+    """
+    Minibatch loss and gradient at W and gradient at W_snap, both on the
+    same rows of every shard, as needed by the SVRG inner steps.
+
+    Returns a tuple of:
+    - loss: Scalar loss at W
+    - dW: Gradient at W
+    - dW_snap: Gradient at W_snap
+    """
+    batch_size = max(1, batch_size // self.num_workers)
+    self._calls += 1
+    tasks = [(i, W, W_snap, reg, batch_size, self._calls * self.num_workers + i)
+             for i in xrange(self.num_workers)]
+    results = self.pool.map(_shard_loss_pair, tasks)
+    total = float(sum(r[0] for r in results))
+    loss = sum(r[0] / total * r[1] for r in results)
+    grad = sum(r[0] / total * r[2] for r in results)
+    snap_grad = sum(r[0] / total * r[3] for r in results)
+    return loss, grad, snap_grad
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+
+def hogwild_train(loss_fn, X, y, W, learning_rate, reg, num_iters, batch_size,
+                  num_workers=None, seed=0):
+  """
+  Hogwild-style asynchronous SGD: W lives in shared memory and every worker
+  runs minibatch SGD on its own shard, updating W in place without locks.
+
+  Inputs:
+  - loss_fn: A function loss_fn(W, X, y, reg) -> (loss, dW).
+  - X, y: Training data and labels.
+  - W: Initial weights of shape (D, C).
+  - learning_rate, reg, batch_size: As for LinearClassifier.train.
+  - num_iters: Total number of minibatch steps, split across the workers.
+  - num_workers: Number of processes; defaults to the number of CPUs.
+  - seed: Base seed of the per-worker random number generators.
+
+  Returns a tuple of:
+  - W: The trained weights.
+  - loss_history: Minibatch losses, interleaved across the workers.
+  """
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  shared_W = RawArray('d', W.size)
+  W_view = np.frombuffer(shared_W).reshape(W.shape)
+  W_view[:] = W
+  bounds = shard_bounds(X.shape[0], num_workers)
+  steps = max(num_iters // num_workers, 1)
+
+  pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(loss_fn, X, y, bounds, shared_W, W.shape))
+  try:
+    tasks = [(i, learning_rate, reg, steps, batch_size, seed + i)
+             for i in xrange(num_workers)]
+    per_worker = pool.map(_hogwild_worker, tasks)
+  finally:
+    pool.close()
+    pool.join()
+
+  loss_history = [l for step in zip(*per_worker) for l in step]
+  return W_view.copy(), loss_history
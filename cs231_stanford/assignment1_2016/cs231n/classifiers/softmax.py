@@ -60,7 +60,9 @@ def softmax_loss_vectorized(W, X, y, reg):
   """
   Softmax loss function, vectorized version.
 
-  Inputs and outputs are the same as softmax_loss_naive.
+  Inputs and outputs are the same as softmax_loss_naive, except that X may
+  also be a scipy.sparse CSR matrix. X only enters through sparse-dense
+  products, so it is never densified.
   """
   # Initialize the loss and gradient to zero.
   loss = 0.0
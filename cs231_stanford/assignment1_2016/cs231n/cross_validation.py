@@ -0,0 +1,127 @@
+import itertools
+import multiprocessing
+import numpy as np
+
+from cs231n.classifiers.k_nearest_neighbor import KNearestNeighbor
+
+"""
+k-fold cross-validation for the kNN and linear classifiers.
+"""
+
+
+def fold_indices(num_train, num_folds):
+  """
+  Split range(num_train) into num_folds contiguous folds, as np.array_split
+  does for the data itself.
+
+  Returns:
+  - folds: A list of num_folds integer arrays.
+  """
+  return np.array_split(np.arange(num_train), num_folds)
+
+
+def knn_cross_validate(X, y, k_choices, num_folds=5, max_memory=None):
+  """
+  Cross-validate the number of neighbors k of a KNearestNeighbor classifier.
+
+  For each fold, the neighbors of the held-out points are computed once for
+  the largest k in k_choices; every other k reuses a prefix of that sorted
+  neighbor list, so distances are never recomputed per k.
+
+  Inputs:
+  - X: A numpy array of shape (N, D) of training data.
+  - y: A numpy array of shape (N,) of training labels.
+  - k_choices: List of values of k to evaluate.
+  - num_folds: Number of folds.
+  - max_memory: Passed on to KNearestNeighbor.compute_neighbors.
+
+  Returns:
+  - k_to_accuracies: A dictionary mapping each k to a list of num_folds
+    validation accuracies.
+  """
+  k_to_accuracies = dict((k, []) for k in k_choices)
+  max_k = max(k_choices)
+  for val_idx in fold_indices(X.shape[0], num_folds):
+    train_idx = np.setdiff1d(np.arange(X.shape[0]), val_idx)
+
+    classifier = KNearestNeighbor()
+    classifier.train(X[train_idx], y[train_idx])
+    _, neighbors = classifier.compute_neighbors(X[val_idx], k=max_k,
+                                                max_memory=max_memory)
+    for k in k_choices:
+      y_pred = classifier.vote_labels(neighbors[:, :k])
+      k_to_accuracies[k].append(np.mean(y_pred == y[val_idx]))
+  return k_to_accuracies
+
+
+# Training data shared with the worker processes. It is handed over through the
+# pool initializer, so with the fork start method workers inherit the parent's
+# arrays instead of receiving a pickled copy with every job.
+_shared = {}
+
+
+def _init_worker(X, y, folds):
+  _shared['X'], _shared['y'], _shared['folds'] = X, y, folds
+
+
+def _run_linear_job(job):
+  model_class, fold, learning_rate, reg, train_kwargs, seed = job
+  X, y, folds = _shared['X'], _shared['y'], _shared['folds']
+  np.random.seed(seed)
+
+  # Integer row indices, so that X may also be a scipy.sparse CSR matrix
+  train_idx = np.setdiff1d(np.arange(X.shape[0]), folds[fold])
+  model = model_class()
+  model.train(X[train_idx], y[train_idx], learning_rate=learning_rate,
+              reg=reg, **train_kwargs)
+  y_pred = model.predict(X[folds[fold]])
+  return np.mean(y_pred == y[folds[fold]])
+
+
+def linear_cross_validate(model_class, X, y, learning_rates, regs,
+                          num_folds=5, num_workers=None, seed=0, **train_kwargs):
+  """
+  Cross-validate learning_rate and reg of a LinearClassifier subclass.
+
+  Every (fold, learning_rate, reg) combination is an independent job, and the
+  jobs are spread over a process pool that shares X and y.
+
+  Inputs:
+  - model_class: A LinearClassifier subclass such as LinearSVM or Softmax.
+  - X: A numpy array or scipy.sparse CSR matrix of shape (N, D) of training
+    data.
+  - y: A numpy array of shape (N,) of training labels.
+  - learning_rates, regs: Lists of values to try.
+  - num_folds: Number of folds.
+  - num_workers: Number of processes; defaults to the number of CPUs. Use 1
+    to run the jobs in this process.
+  - seed: Base random seed; each job gets its own seed derived from it so that
+    results do not depend on scheduling.
+  - train_kwargs: Extra keyword arguments for model.train, e.g. num_iters.
+
+  Returns:
+  - results: A dictionary mapping (learning_rate, reg) tuples to lists of
+    num_folds validation accuracies.
+  """
+  folds = fold_indices(X.shape[0], num_folds)
+  combos = list(itertools.product(learning_rates, regs))
+  jobs = []
+  for j, ((lr, reg), fold) in enumerate(itertools.product(combos, range(num_folds))):
+    jobs.append((model_class, fold, lr, reg, train_kwargs, seed + j))
+
+  if num_workers == 1:
+    _init_worker(X, y, folds)
+    accuracies = [_run_linear_job(job) for job in jobs]
+  else:
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=(X, y, folds))
+    try:
+      accuracies = pool.map(_run_linear_job, jobs)
+    finally:
+      pool.close()
+      pool.join()
+
+  results = {}
+  for job, acc in zip(jobs, accuracies):
+    results.setdefault((job[2], job[3]), []).append(acc)
+  return results
@@ -1,14 +1,124 @@
+from __future__ import print_function
+from functools import partial
+import hashlib
+import multiprocessing
+import os
 import matplotlib
 import numpy as np
 from scipy.ndimage import uniform_filter
 
 
-def extract_features(imgs, feature_fns, verbose=False):
+def batched_feature_fn(feature_fn):
+  """
+  Return a function computing feature_fn for a whole N x H x W x C array of
+  images at once, or None if no batched version of feature_fn is known.
+
+  feature_fn may be one of the single-image functions in this file or a
+  functools.partial of one, e.g. partial(color_histogram_hsv, nbin=10); a
+  lambda wrapping them cannot be recognised and falls back to the per-image
+  loop.
+  """
+  if isinstance(feature_fn, partial):
+    batch_fn = _BATCHED.get(feature_fn.func)
+    if batch_fn is None:
+      return None
+    return partial(batch_fn, *feature_fn.args, **(feature_fn.keywords or {}))
+  return _BATCHED.get(feature_fn)
+
+
+# State shared with the extraction worker processes. It is handed over through
+# the pool initializer, so with the fork start method workers inherit the
+# images and feature functions instead of receiving pickled copies.
+_shared = {}
+
+
+def _init_worker(imgs, feature_fns, feature_dims):
+  _shared['imgs'] = imgs
+  _shared['feature_fns'] = feature_fns
+  _shared['batch_fns'] = [batched_feature_fn(fn) for fn in feature_fns]
+  _shared['feature_dims'] = feature_dims
+
+
+def _extract_chunk(bounds):
+  """
+  Compute the float32 features of images start:stop of the shared images.
+  """
+  start, stop = bounds
+  imgs = _shared['imgs']
+  batch = imgs[start:stop]
+  feats = np.empty((stop - start, sum(_shared['feature_dims'])), dtype=np.float32)
+  idx = 0
+  for feature_fn, batch_fn, feature_dim in zip(_shared['feature_fns'],
+                                               _shared['batch_fns'],
+                                               _shared['feature_dims']):
+    next_idx = idx + feature_dim
+    if batch_fn is not None:
+      feats[:, idx:next_idx] = batch_fn(batch)
+    else:
+      for i in xrange(start, stop):
+        feats[i - start, idx:next_idx] = feature_fn(imgs[i].squeeze())
+    idx = next_idx
+  return start, stop, feats
+
+
+def _feature_fn_key(feature_fn):
+  """
+  A string identifying a feature function together with its parameters. Plain
+  functions and lambdas are identified by their name, code, defaults and
+  closure, so editing a function invalidates cached features.
+  """
+  if isinstance(feature_fn, partial):
+    return 'partial(%s, %r, %r)' % (_feature_fn_key(feature_fn.func),
+                                    feature_fn.args,
+                                    sorted((feature_fn.keywords or {}).items()))
+  code = getattr(feature_fn, '__code__', None)
+  if code is None:
+    return repr(feature_fn)
+  closure = [c.cell_contents for c in (feature_fn.__closure__ or ())]
+  closure = [_feature_fn_key(c) if callable(c) else c for c in closure]
+  return '%s.%s(%s, %r, %r)' % (feature_fn.__module__, feature_fn.__name__,
+                                _code_key(code), feature_fn.__defaults__, closure)
+
+
+def _code_key(code):
+  # Nested code objects (inner lambdas, generator expressions) would otherwise
+  # be represented by their memory address.
+  consts = [_code_key(c) if hasattr(c, 'co_code') else c for c in code.co_consts]
+  return repr((code.co_code, consts))
+
+
+def features_cache_key(imgs, feature_fns, block_size=1000):
+  """
+  Hash of the feature functions, their parameters and the image data, used to
+  name cached feature files.
+  """
+  h = hashlib.sha1()
+  h.update(repr((imgs.shape, str(imgs.dtype))).encode('utf-8'))
+  for feature_fn in feature_fns:
+    h.update(_feature_fn_key(feature_fn).encode('utf-8', 'replace'))
+  for start in xrange(0, imgs.shape[0], block_size):
+    h.update(np.ascontiguousarray(imgs[start:start + block_size]).data)
+  return h.hexdigest()
+
+
+def extract_features(imgs, feature_fns, verbose=False, batch_size=1000,
+                     num_workers=1, cache_dir=None):
   """
   Given pixel data for images and several feature functions that can operate on
   single images, apply all feature functions to all images, concatenating the
   feature vectors for each image and storing the features for all images in
-  a single matrix.
+  a single float32 matrix.
+
+  Feature functions with a batched version (see batched_feature_fn) are applied
+  to batch_size images at a time; any other function is called once per image.
+  Chunks of batch_size images are spread over num_workers processes.
+
+  If cache_dir is given, the features are written to a memory-mapped .npy file
+  in that directory, named after a hash of the feature functions, their
+  parameters and the images (see features_cache_key). A later call with the
+  same inputs maps that file instead of recomputing it. Cached features are
+  mapped copy-on-write: in-place changes such as mean subtraction stay in
+  memory and never modify the cache.
 
   Inputs:
   - imgs: N x H X W X C array of pixel data for N images.
@@ -16,40 +126,76 @@ def extract_features(imgs, feature_fns, verbose=False):
     take as input an H x W x D array and return a (one-dimensional) array of
     length F_i.
   - verbose: Boolean; if true, print progress.
+  - batch_size: Number of images per chunk.
+  - num_workers: Number of processes; None uses one per CPU and 1 extracts in
+    this process.
+  - cache_dir: Directory of cached feature files, or None to disable caching.
 
   Returns:
-  An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
+  An array of shape (N, F_1 + ... + F_k) where each row is the concatenation
   of all features for a single image.
   """
   num_images = imgs.shape[0]
   if num_images == 0:
     return np.array([])
 
+  if cache_dir is not None:
+    path = os.path.join(cache_dir, 'features_%s.npy'
+                        % features_cache_key(imgs, feature_fns))
+    if os.path.exists(path):
+      if verbose:
+        print('Loading cached features from %s' % path)
+      return np.load(path, mmap_mode='c')
+
   # Use the first image to determine feature dimensions
   feature_dims = []
-  first_image_features = []
   for feature_fn in feature_fns:
     feats = feature_fn(imgs[0].squeeze())
     assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
     feature_dims.append(feats.size)
-    first_image_features.append(feats)
 
   # Now that we know the dimensions of the features, we can allocate a single
-  # big array to store all features as columns.
-  total_feature_dim = sum(feature_dims)
-  imgs_features = np.zeros((num_images, total_feature_dim))
-  imgs_features[0] = np.hstack(first_image_features).T
-
-  # Extract features for the rest of the images.
-  for i in xrange(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
-    if verbose and i % 1000 == 0:
-      print 'Done extracting features for %d / %d images' % (i, num_images)
+  # big array to store all features as rows.
+  shape = (num_images, sum(feature_dims))
+  if cache_dir is not None:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    imgs_features = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                              dtype=np.float32, shape=shape)
+  else:
+    imgs_features = np.empty(shape, dtype=np.float32)
 
+  chunks = [(start, min(start + batch_size, num_images))
+            for start in xrange(0, num_images, batch_size)]
+  if num_workers == 1:
+    _init_worker(imgs, feature_fns, feature_dims)
+    results = (_extract_chunk(chunk) for chunk in chunks)
+    pool = None
+  else:
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=(imgs, feature_fns, feature_dims))
+    results = pool.imap_unordered(_extract_chunk, chunks)
+  try:
+    done = 0
+    for start, stop, feats in results:
+      imgs_features[start:stop] = feats
+      done += stop - start
+      if verbose:
+        print('Done extracting features for %d / %d images' % (done, num_images))
+  finally:
+    _shared.clear()
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  if cache_dir is not None:
+    # Publish the finished file atomically, so an interrupted run never leaves
+    # a truncated cache entry behind.
+    imgs_features.flush()
+    del imgs_features
+    os.rename(tmp_path, path)
+    return np.load(path, mmap_mode='c')
   return imgs_features
 
 
@@ -145,4 +291,123 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   return imhist
 
 
+def _bin_index(x, edges):
+  """
+  Index i of the histogram bin edges[i] <= x < edges[i + 1], or -1 if x lies
+  outside [edges[0], edges[-1]); the same half-open bins that the comparisons
+  in hog_feature use.
+  """
+  idx = np.searchsorted(edges, x, side='right') - 1
+  idx[idx >= edges.shape[0] - 1] = -1
+  return idx
+
+
+def hog_feature_batch(imgs):
+  """Compute the HOG feature of hog_feature for a batch of images.
+
+  Each pixel's gradient magnitude is added to the (cell, orientation) bin it
+  falls in with a single bincount over the whole batch, which is the same
+  8 x 8 cell average that the uniform_filter passes of hog_feature sample.
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images, or N x H x W grayscale images
+
+    Returns:
+      feats: N x F array where feats[i] == hog_feature(imgs[i])
+  """
+  if imgs.ndim == 4 and imgs.shape[3] == 1:
+    imgs = imgs[..., 0]
+  if imgs.ndim == 4:
+    image = rgb2gray(imgs)
+  else:
+    image = np.asarray(imgs, dtype=np.float64)
+
+  N, sx, sy = image.shape
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+
+  gx = np.zeros(image.shape)
+  gy = np.zeros(image.shape)
+  gx[:, :, :-1] = np.diff(image, n=1, axis=2) # compute gradient on x-direction
+  gy[:, :-1, :] = np.diff(image, n=1, axis=1) # compute gradient on y-direction
+  grad_mag = np.sqrt(gx ** 2 + gy ** 2) # gradient magnitude
+  grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90 # gradient orientation
+
+  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+  # Only pixels inside whole cells contribute
+  grad_mag = grad_mag[:, :n_cellsx * cx, :n_cellsy * cy]
+  grad_ori = grad_ori[:, :n_cellsx * cx, :n_cellsy * cy]
+
+  edges = 180. / orientations * np.arange(orientations + 1)
+  ori_bin = _bin_index(grad_ori, edges)
+  # Zero orientations are dropped by hog_feature as well
+  valid = (ori_bin >= 0) & (grad_ori > 0)
+
+  # Offset bins: (image, cell row, cell column, orientation) -> flat index
+  cell_x = np.arange(n_cellsx * cx) // cx
+  cell_y = np.arange(n_cellsy * cy) // cy
+  cell = cell_x[:, None] * n_cellsy + cell_y[None, :]
+  flat = ((np.arange(N)[:, None, None] * (n_cellsx * n_cellsy) + cell) * orientations
+          + ori_bin)
+  hist = np.bincount(flat[valid], weights=grad_mag[valid],
+                     minlength=N * n_cellsx * n_cellsy * orientations)
+  hist = hist.reshape(N, n_cellsx, n_cellsy, orientations) / (cx * cy)
+
+  # hog_feature stores the cells transposed
+  return hist.transpose(0, 2, 1, 3).reshape(N, -1)
+
+
+def _rgb_to_hue(rgb):
+  """
+  The hue channel of matplotlib.colors.rgb_to_hsv, in [0, 1), without
+  computing saturation and value.
+  """
+  r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+  arr_max = rgb.max(-1)
+  delta = arr_max - rgb.min(-1)
+  gray = delta <= 0
+  delta[gray] = 1
+  # Ties go to the last matching channel, as in rgb_to_hsv
+  hue = np.where(b == arr_max, 4. + (r - g) / delta,
+                 np.where(g == arr_max, 2. + (b - r) / delta, (g - b) / delta))
+  hue[gray] = 0
+  return (hue / 6.0) % 1.0
+
+
+def color_histogram_hsv_batch(imgs, nbin=10, xmin=0, xmax=255, normalized=True):
+  """
+  Compute the hue histogram of color_histogram_hsv for a batch of images with
+  a single bincount over offset bins.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin, xmin, xmax, normalized: As for color_histogram_hsv.
+
+  Returns:
+    N x nbin array whose ith row is color_histogram_hsv(imgs[i], ...).
+  """
+  N = imgs.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  hue = _rgb_to_hue(imgs/xmax).reshape(N, -1) * xmax
+
+  # np.histogram closes the last bin on the right
+  idx = _bin_index(hue, bins)
+  idx[hue == bins[-1]] = nbin - 1
+  valid = idx >= 0
+  flat = (np.arange(N)[:, None] * nbin + idx)[valid]
+  imhist = np.bincount(flat, minlength=N * nbin).reshape(N, nbin).astype(np.float64)
+  if normalized:
+    imhist /= imhist.sum(axis=1, keepdims=True)
+  else:
+    imhist *= np.diff(bins)
+  return imhist
+
+
+_BATCHED = {
+  hog_feature: hog_feature_batch,
+  color_histogram_hsv: color_histogram_hsv_batch,
+}
+
+
 pass
@@ -0,0 +1,219 @@
+from __future__ import print_function, division
+from builtins import range
+import numpy as np
+
+"""
+This file implements corpus-level caption metrics that work directly on the
+integer caption arrays produced by CaptioningRNN.sample and load_coco_data,
+without decoding them to strings.
+
+N-grams are identified by 64-bit hashes of their token ids, so counting and
+clipping reduce to np.unique / searchsorted over flat integer arrays.
+"""
+
+_FNV_PRIME = np.uint64(1099511628211)
+_FNV_OFFSET = np.uint64(14695981039346656037)
+_GROUP_MUL = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(x):
+    """
+    splitmix64 finalizer; scrambles an array of uint64 keys.
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def caption_lengths(captions, null, start=None, end=None):
+    """
+    Strip an optional leading <START> token and find the caption lengths.
+
+    Inputs:
+    - captions: Integer array of shape (N, T).
+    - null, start, end: Indices of the <NULL>, <START> and <END> tokens.
+
+    Returns a tuple of:
+    - tokens: Integer array of shape (N, T) where each row starts at the first
+      real word.
+    - lengths: Integer array of shape (N,) giving the number of words in each
+      caption, not counting <END> or anything after it.
+    """
+    tokens = np.asarray(captions)
+    if tokens.ndim == 1:
+        tokens = tokens[None]
+    N, T = tokens.shape
+    if start is not None:
+        has_start = (tokens[:, 0] == start)
+        if np.any(has_start):
+            shifted = np.empty_like(tokens)
+            shifted[:, :-1] = tokens[:, 1:]
+            shifted[:, -1] = null
+            tokens = np.where(has_start[:, None], shifted, tokens)
+
+    stop = (tokens == null)
+    if end is not None:
+        stop |= (tokens == end)
+    lengths = np.where(stop.any(axis=1), stop.argmax(axis=1), T)
+    return tokens, lengths
+
+
+def _ngram_hashes(tokens, lengths, n):
+    """
+    Hash every n-gram of every row.
+
+    Returns a tuple of:
+    - hashes: uint64 array of the hashes of all valid n-grams
+    - rows: The row each of those n-grams came from
+    """
+    N, T = tokens.shape
+    if T < n:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    num_pos = T - n + 1
+    tok = tokens.astype(np.uint64)
+    h = np.full((N, num_pos), _FNV_OFFSET, dtype=np.uint64)
+    for j in range(n):
+        h = (h ^ tok[:, j:j + num_pos]) * _FNV_PRIME
+    valid = np.arange(num_pos)[None, :] + n <= lengths[:, None]
+    rows = np.broadcast_to(np.arange(N)[:, None], (N, num_pos))
+    return h[valid], rows[valid]
+
+
+def _group_keys(hashes, groups):
+    return _mix(hashes + groups.astype(np.uint64) * _GROUP_MUL)
+
+
+def _reference_max_counts(hashes, rows, ref_groups):
+    """
+    For every (image, n-gram) pair, the maximum count of that n-gram in any
+    single reference caption of the image.
+
+    Returns a tuple of sorted unique keys and the parallel max counts.
+    """
+    row_keys = _group_keys(hashes, rows)
+    _, first, counts = np.unique(row_keys, return_index=True, return_counts=True)
+    image_keys = _group_keys(hashes[first], ref_groups[rows[first]])
+
+    order = np.argsort(image_keys, kind='mergesort')
+    image_keys, counts = image_keys[order], counts[order]
+    if image_keys.shape[0] == 0:
+        return image_keys, counts
+    starts = np.flatnonzero(np.r_[True, image_keys[1:] != image_keys[:-1]])
+    return image_keys[starts], np.maximum.reduceat(counts, starts)
+
+
+def _closest_reference_lengths(cand_lengths, cand_groups, ref_lengths, ref_groups):
+    """
+    For each candidate, the length of the reference of the same image whose
+    length is closest, breaking ties towards the shorter reference. Candidates
+    without references get -1.
+    """
+    order = np.argsort(ref_groups, kind='mergesort')
+    sorted_groups, sorted_lengths = ref_groups[order], ref_lengths[order]
+    lo = np.searchsorted(sorted_groups, cand_groups, side='left')
+    hi = np.searchsorted(sorted_groups, cand_groups, side='right')
+    num_refs = hi - lo
+
+    closest = np.full(cand_lengths.shape[0], -1, dtype=np.int64)
+    has_ref = num_refs > 0
+    if not np.any(has_ref):
+        return closest
+    lo, num_refs = lo[has_ref], num_refs[has_ref]
+
+    # Expand each candidate into one slot per reference of its image.
+    offsets = np.cumsum(num_refs) - num_refs
+    slot = np.arange(num_refs.sum()) - np.repeat(offsets, num_refs)
+    ref_idx = np.repeat(lo, num_refs) + slot
+    lengths = sorted_lengths[ref_idx].astype(np.int64)
+    diff = np.abs(lengths - np.repeat(cand_lengths[has_ref], num_refs))
+
+    base = int(sorted_lengths.max()) + 1
+    best = np.minimum.reduceat(diff * base + lengths, offsets)
+    closest[has_ref] = best % base
+    return closest
+
+
+def corpus_bleu(candidates, candidate_groups, references, reference_groups,
+                null, start=None, end=None, max_n=4):
+    """
+    Compute corpus-level BLEU-1 through BLEU-max_n.
+
+    Inputs:
+    - candidates: Integer array of shape (N, T) of generated captions, as
+      returned by CaptioningRNN.sample.
+    - candidate_groups: Integer array of shape (N,) giving the image each
+      candidate describes.
+    - references: Integer array of shape (M, T') of ground-truth captions, e.g.
+      data['val_captions'].
+    - reference_groups: Integer array of shape (M,) giving the image each
+      reference describes, e.g. data['val_image_idxs'].
+    - null, start, end: Indices of the <NULL>, <START> and <END> tokens.
+    - max_n: Largest n-gram order.
+
+    Returns:
+    - bleu: Array of shape (max_n,) where bleu[n - 1] is the BLEU-n score.
+    """
+    candidate_groups = np.asarray(candidate_groups)
+    reference_groups = np.asarray(reference_groups)
+    cand, cand_lengths = caption_lengths(candidates, null, start, end)
+    ref, ref_lengths = caption_lengths(references, null, start, end)
+
+    matches = np.zeros(max_n)
+    totals = np.zeros(max_n)
+    for n in range(1, max_n + 1):
+        ref_hashes, ref_rows = _ngram_hashes(ref, ref_lengths, n)
+        ref_keys, ref_max = _reference_max_counts(ref_hashes, ref_rows, reference_groups)
+
+        cand_hashes, cand_rows = _ngram_hashes(cand, cand_lengths, n)
+        totals[n - 1] = cand_hashes.shape[0]
+        if cand_hashes.shape[0] == 0 or ref_keys.shape[0] == 0:
+            continue
+        _, first, counts = np.unique(_group_keys(cand_hashes, cand_rows),
+                                     return_index=True, return_counts=True)
+        image_keys = _group_keys(cand_hashes[first], candidate_groups[cand_rows[first]])
+
+        pos = np.minimum(np.searchsorted(ref_keys, image_keys), ref_keys.shape[0] - 1)
+        clip = np.where(ref_keys[pos] == image_keys, ref_max[pos], 0)
+        matches[n - 1] = np.minimum(counts, clip).sum()
+
+    closest = _closest_reference_lengths(cand_lengths, candidate_groups,
+                                         ref_lengths, reference_groups)
+    c = cand_lengths.sum()
+    r = closest[closest >= 0].sum()
+    if c == 0:
+        return np.zeros(max_n)
+    brevity_penalty = 1.0 if c > r else np.exp(1 - r / c)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_precision = np.log(matches / np.maximum(totals, 1))
+    log_avg = np.cumsum(log_precision) / np.arange(1, max_n + 1)
+    return brevity_penalty * np.exp(log_avg)
+
+
+def evaluate_captioning_bleu(model, features, image_idxs, references,
+                             reference_groups, max_length=30, batch_size=100):
+    """
+    Sample captions from a model and score them against the references.
+
+    This is a module-level function so that it can be submitted to a worker
+    process; see CaptioningSolver.check_accuracy.
+
+    Inputs:
+    - model: A CaptioningRNN-compatible model with a sample method.
+    - features: Array of shape (N, D) of image features to caption.
+    - image_idxs: Integer array of shape (N,) giving the image id of each row
+      of features.
+    - references, reference_groups: See corpus_bleu.
+
+    Returns:
+    - bleu: Array of shape (4,) of BLEU-1..4 scores.
+    """
+    N = features.shape[0]
+    captions = []
+    for i in range(0, N, batch_size):
+        captions.append(model.sample(features[i:i + batch_size], max_length=max_length))
+    captions = np.concatenate(captions, axis=0)
+    return corpus_bleu(captions, image_idxs, references, reference_groups,
+                       model._null, model._start, model._end)
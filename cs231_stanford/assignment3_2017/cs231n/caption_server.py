@@ -0,0 +1,302 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import asyncio
+import itertools
+
+import numpy as np
+
+from cs231n.layers import affine_forward
+from cs231n.rnn_layers import cell_step_forward
+
+"""
+This file implements an incremental decoder for a trained CaptioningRNN, along
+with an asyncio front end that micro-batches concurrent caption requests.
+"""
+
+
+class CaptionDecoder(object):
+    """
+    A CaptionDecoder keeps the recurrent state of many in-flight caption
+    requests and advances all of them together, one word per call to step().
+
+    Unlike CaptioningRNN.sample, requests may be added and retired between
+    steps. The image features of each request are projected through W_proj
+    exactly once when the request is added; afterwards only the per-request
+    hidden state h, cell state c and previous word are kept, for every layer of
+    the model. Every step makes a single cell_step_forward call per layer over
+    all active requests.
+
+    Example usage:
+
+    decoder = CaptionDecoder(model, max_length=16)
+    ids = decoder.add(features)
+    while decoder.num_active > 0:
+        decoder.step()
+    captions = decoder.pop_finished()
+    """
+
+    def __init__(self, model, max_length=30):
+        """
+        Construct a new CaptionDecoder.
+
+        Inputs:
+        - model: A trained CaptioningRNN instance.
+        - max_length: Maximum length T of generated captions.
+        """
+        self.model = model
+        self.max_length = max_length
+
+        H = model.params['W_proj'].shape[1]
+        L = getattr(model, 'num_layers', 1)
+        dtype = model.params['W_proj'].dtype
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._h = np.zeros((0, L, H), dtype=dtype)
+        self._c = np.zeros((0, L, H), dtype=dtype)
+        self._words = np.zeros(0, dtype=np.int32)
+        self._lengths = np.zeros(0, dtype=np.int32)
+        self._captions = np.zeros((0, max_length), dtype=np.int32)
+        self._finished = {}
+        self._counter = itertools.count()
+
+    @property
+    def num_active(self):
+        return self._ids.shape[0]
+
+    def add(self, features):
+        """
+        Register new caption requests.
+
+        Inputs:
+        - features: Array of image features of shape (N, D), or a single
+          feature vector of shape (D,).
+
+        Returns:
+        - ids: Integer array of shape (N,) giving a request id for each row.
+        """
+        features = np.atleast_2d(features)
+        N = features.shape[0]
+        W_proj, b_proj = self.model.params['W_proj'], self.model.params['b_proj']
+
+        h0 = affine_forward(features, W_proj, b_proj)[0].astype(self._h.dtype)
+        h0 = np.repeat(h0[:, None, :], self._h.shape[1], axis=1)  # (N, L, H)
+        ids = np.fromiter(itertools.islice(self._counter, N), dtype=np.int64, count=N)
+
+        self._ids = np.concatenate((self._ids, ids))
+        self._h = np.concatenate((self._h, h0))
+        self._c = np.concatenate((self._c, np.zeros_like(h0)))
+        self._words = np.concatenate(
+            (self._words, self.model._start * np.ones(N, dtype=np.int32)))
+        self._lengths = np.concatenate((self._lengths, np.zeros(N, dtype=np.int32)))
+        self._captions = np.concatenate(
+            (self._captions, self.model._null * np.ones((N, self.max_length), dtype=np.int32)))
+        return ids
+
+    def step(self):
+        """
+        Advance every active request by one word. Requests that produce the
+        <END> token or reach max_length are retired and can be collected with
+        pop_finished().
+
+        Returns:
+        - done: Integer array giving the ids of requests retired by this step.
+        """
+        if self.num_active == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        params = self.model.params
+        x = params['W_embed'][self._words]  # (N, W)
+
+        for l, (Wx, Wh, b) in enumerate(self.model._layers()):
+            x, c, _ = cell_step_forward(self.model.cell_type, x, self._h[:, l],
+                                        self._c[:, l], Wx, Wh, b)
+            self._h[:, l], self._c[:, l] = x, c
+
+        scores = affine_forward(x, params['W_vocab'], params['b_vocab'])[0]
+        self._words = np.argmax(scores, axis=1).astype(np.int32)  # (N,)
+
+        rows = np.arange(self.num_active)
+        self._captions[rows, self._lengths] = self._words
+        self._lengths += 1
+
+        done = (self._lengths >= self.max_length)
+        if self.model._end is not None:
+            done |= (self._words == self.model._end)
+        return self._retire(done)
+
+    def pop_finished(self):
+        """
+        Collect the captions of all retired requests.
+
+        Returns:
+        - finished: Dictionary mapping request ids to integer arrays of shape
+          (max_length,); positions after the last generated word hold <NULL>.
+        """
+        finished, self._finished = self._finished, {}
+        return finished
+
+    def cancel(self, ids):
+        """
+        Drop active requests without producing a caption for them.
+        """
+        self._compact(np.isin(self._ids, ids))
+
+    def _retire(self, done):
+        done_ids = self._ids[done]
+        for rid, caption in zip(done_ids, self._captions[done]):
+            self._finished[int(rid)] = caption
+        self._compact(done)
+        return done_ids
+
+    def _compact(self, drop):
+        if not np.any(drop):
+            return
+        keep = ~drop
+        self._ids = self._ids[keep]
+        self._h = self._h[keep]
+        self._c = self._c[keep]
+        self._words = self._words[keep]
+        self._lengths = self._lengths[keep]
+        self._captions = self._captions[keep]
+
+
+class AsyncCaptionServer(object):
+    """
+    An asyncio front end for a CaptionDecoder.
+
+    Callers await caption(features) from any number of coroutines. Requests
+    that arrive within batch_window seconds of each other are admitted to the
+    decoder together, and every tick of the serving loop advances all active
+    requests with a single micro-batched step, so new requests join the batch
+    without waiting for older ones to finish.
+
+    Example usage:
+
+    server = AsyncCaptionServer(CaptionDecoder(model), batch_window=0.002)
+    task = asyncio.ensure_future(server.serve())
+    caption = await server.caption(features[0])
+    server.stop()
+    await task
+    """
+
+    def __init__(self, decoder, batch_window=0.002, max_batch_size=256):
+        """
+        Inputs:
+        - decoder: A CaptionDecoder instance.
+        - batch_window: Seconds to wait for more requests to arrive once the
+          decoder is idle and a first request has arrived.
+        - max_batch_size: Maximum number of requests decoded together; extra
+          requests wait in the queue until a slot frees up.
+        """
+        self.decoder = decoder
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._queue = None
+        self._futures = {}
+        self._running = False
+
+    async def caption(self, features):
+        """
+        Caption a single image feature vector of shape (D,).
+
+        Returns:
+        - caption: Integer array of shape (max_length,).
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((np.asarray(features), future))
+        return await future
+
+    def stop(self):
+        self._running = False
+        if self._queue is not None:
+            self._queue.put_nowait(None)
+
+    async def serve(self):
+        """
+        Run the serving loop until stop() is called.
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._running = True
+        while self._running:
+            pending = []
+            if self.decoder.num_active == 0:
+                # Idle: block for the first request, then open the window.
+                item = await self._queue.get()
+                if item is not None:
+                    pending.append(item)
+                    await asyncio.sleep(self.batch_window)
+            pending.extend(self._drain(self.max_batch_size - self.decoder.num_active - len(pending)))
+            pending = [p for p in pending if p is not None]
+
+            self._drop_cancelled()
+            pending = [p for p in pending if not p[1].cancelled()]
+            if pending:
+                try:
+                    features = np.stack([f for f, _ in pending])
+                    ids = self.decoder.add(features)
+                except Exception as e:
+                    # Bad feature shapes fail in np.stack or the projection,
+                    # before the decoder state changes, so only this batch
+                    # is affected.
+                    for _, future in pending:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for rid, (_, future) in zip(ids, pending):
+                        self._futures[int(rid)] = future
+
+            try:
+                self.decoder.step()
+                finished = self.decoder.pop_finished()
+            except Exception as e:
+                # The decoder state can no longer be trusted; fail every
+                # outstanding request so that no caller waits forever.
+                self._running = False
+                self._finish_outstanding(e)
+                raise
+            for rid, caption in finished.items():
+                future = self._futures.pop(rid)
+                if not future.done():
+                    future.set_result(caption)
+
+            # Yield so that callers can enqueue between ticks.
+            await asyncio.sleep(0)
+
+        self._finish_outstanding()
+
+    def _drop_cancelled(self):
+        """
+        Stop decoding requests whose callers cancelled them.
+        """
+        cancelled = [rid for rid, f in self._futures.items() if f.cancelled()]
+        if cancelled:
+            self.decoder.cancel(cancelled)
+            for rid in cancelled:
+                del self._futures[rid]
+
+    def _finish_outstanding(self, exc=None):
+        """
+        Resolve every request that is being decoded or still queued: cancel
+        them, or fail them with exc if given.
+        """
+        self.decoder.cancel(list(self._futures.keys()))
+        futures = list(self._futures.values())
+        futures.extend(item[1] for item in self._drain(self._queue.qsize())
+                       if item is not None)
+        self._futures = {}
+        for future in futures:
+            if future.done():
+                continue
+            if exc is None:
+                future.cancel()
+            else:
+                future.set_exception(exc)
+
+    def _drain(self, limit):
+        items = []
+        while len(items) < limit and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
@@ -1,12 +1,28 @@
 from __future__ import print_function, division
 from builtins import range
 from builtins import object
+import copy
 import numpy as np
 
 from cs231n import optim
+from cs231n.caption_metrics import evaluate_captioning_bleu
 from cs231n.coco_utils import sample_coco_minibatch
 
 
+class _FinishedEval(object):
+    """
+    Stand-in for a future whose result was computed inline.
+    """
+    def __init__(self, result):
+        self._result = result
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self._result
+
+
 class CaptioningSolver(object):
     """
     A CaptioningSolver encapsulates all the logic necessary for training
@@ -26,8 +42,9 @@ class CaptioningSolver(object):
     that performed best on the validation set over the course of training.
     In addition, the instance variable solver.loss_history will contain a list
     of all losses encountered during training and the instance variables
-    solver.train_acc_history and solver.val_acc_history will be lists containing
-    the accuracies of the model on the training and validation set at each epoch.
+    solver.val_bleu_history will contain the BLEU-1..4 scores of the model on a
+    sample of the validation set at each epoch; solver.val_acc_history holds the
+    BLEU-4 score alone.
 
     Example usage might look something like this:
 
@@ -88,6 +105,16 @@ class CaptioningSolver(object):
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
           training.
+        - num_val_samples: Number of validation images on which to compute BLEU
+          at the end of every epoch; set to 0 or None to disable. Default 1000.
+        - eval_max_length: Maximum caption length sampled for evaluation.
+        - async_eval: Boolean; if true (the default) evaluation runs in a worker
+          process on a snapshot of the parameters so training does not stall.
+          Falls back to inline evaluation when concurrent.futures is not
+          available (Python 2 without the futures backport).
+        - eval_seed: Seed for choosing the validation images that are scored
+          each epoch, so that runs with the same seed score the same subsets.
+          Default 0.
         """
         self.model = model
         self.data = data
@@ -102,6 +129,11 @@ class CaptioningSolver(object):
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
 
+        self.num_val_samples = kwargs.pop('num_val_samples', 1000)
+        self.eval_max_length = kwargs.pop('eval_max_length', 30)
+        self.async_eval = kwargs.pop('async_eval', True)
+        self.eval_seed = kwargs.pop('eval_seed', 0)
+
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
             extra = ', '.join('"%s"' % k for k in list(kwargs.keys()))
@@ -128,6 +160,10 @@ class CaptioningSolver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.val_bleu_history = []
+        self._pending_evals = []
+        self._executor = None
+        self._eval_rng = np.random.RandomState(self.eval_seed)
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -160,47 +196,95 @@ class CaptioningSolver(object):
             self.optim_configs[p] = next_config
 
 
-    # TODO: This does nothing right now; maybe implement BLEU?
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    def _sample_eval_data(self, split, num_samples):
+        """
+        Pick a random subset of images from a split, along with all of their
+        reference captions.
+        """
+        image_idxs = np.unique(self.data['%s_image_idxs' % split])
+        if num_samples is not None and image_idxs.shape[0] > num_samples:
+            image_idxs = self._eval_rng.choice(image_idxs, num_samples, replace=False)
+        features = self.data['%s_features' % split][image_idxs]
+
+        ref_mask = np.isin(self.data['%s_image_idxs' % split], image_idxs)
+        references = self.data['%s_captions' % split][ref_mask]
+        reference_groups = self.data['%s_image_idxs' % split][ref_mask]
+        return features, image_idxs, references, reference_groups
+
+
+    def _snapshot_model(self):
         """
-        Check accuracy of the model on the provided data.
+        Shallow-copy the model with its own copy of the parameters, so that it
+        can be evaluated while training keeps updating self.model.
+        """
+        model = copy.copy(self.model)
+        model.params = {k: v.copy() for k, v in self.model.params.items()}
+        return model
+
+
+    def check_accuracy(self, split='val', num_samples=1000, batch_size=100):
+        """
+        Check the corpus BLEU score of captions sampled from the model.
 
         Inputs:
-        - X: Array of data, of shape (N, d_1, ..., d_k)
-        - y: Array of labels, of shape (N,)
-        - num_samples: If not None, subsample the data and only test the model
-          on num_samples datapoints.
-        - batch_size: Split X and y into batches of this size to avoid using too
+        - split: Which split of the data to evaluate on, 'train' or 'val'.
+        - num_samples: If not None, subsample the images and only test the model
+          on num_samples of them.
+        - batch_size: Sample captions in batches of this size to avoid using too
           much memory.
 
         Returns:
-        - acc: Scalar giving the fraction of instances that were correctly
-          classified by the model.
-        """
-        return 0.0
-
-        # Maybe subsample the data
-        N = X.shape[0]
-        if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
-            N = num_samples
-            X = X[mask]
-            y = y[mask]
-
-        # Compute predictions in batches
-        num_batches = N / batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
-
-        return acc
+        - bleu: Array of shape (4,) giving BLEU-1 through BLEU-4.
+        """
+        features, image_idxs, references, reference_groups = \
+            self._sample_eval_data(split, num_samples)
+        return evaluate_captioning_bleu(self.model, features, image_idxs,
+                                        references, reference_groups,
+                                        max_length=self.eval_max_length,
+                                        batch_size=batch_size)
+
+
+    def _submit_eval(self):
+        """
+        Start a validation BLEU evaluation of the current parameters, either in
+        the worker process or inline.
+        """
+        model = self._snapshot_model()
+        args = self._sample_eval_data('val', self.num_val_samples)
+        kwargs = {'max_length': self.eval_max_length, 'batch_size': self.batch_size}
+        if self.async_eval and self._executor is None:
+            try:
+                from concurrent.futures import ProcessPoolExecutor
+            except ImportError:
+                self.async_eval = False
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=1)
+        if self.async_eval:
+            future = self._executor.submit(evaluate_captioning_bleu, model, *args, **kwargs)
+        else:
+            future = _FinishedEval(evaluate_captioning_bleu(model, *args, **kwargs))
+        self._pending_evals.append((self.epoch, model.params, future))
+
+
+    def _collect_evals(self, wait=False):
+        """
+        Record the results of finished evaluations, in submission order.
+        """
+        while self._pending_evals:
+            epoch, params, future = self._pending_evals[0]
+            if not wait and not future.done():
+                break
+            self._pending_evals.pop(0)
+            bleu = future.result()
+            self.val_bleu_history.append(bleu)
+            self.val_acc_history.append(bleu[-1])
+            if self.verbose:
+                print('(Epoch %d / %d) val BLEU-1..4: %s' % (
+                       epoch, self.num_epochs,
+                       ' '.join('%.4f' % b for b in bleu)))
+            if bleu[-1] > self.best_val_acc:
+                self.best_val_acc = bleu[-1]
+                self.best_params = params
 
 
     def train(self):
@@ -227,9 +311,18 @@ class CaptioningSolver(object):
                 for k in self.optim_configs:
                     self.optim_configs[k]['learning_rate'] *= self.lr_decay
 
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            # TODO: Implement some logic to check Bleu on validation set periodically
+            # Check val BLEU at the end of each epoch. Results from the worker
+            # process are picked up as they become available.
+            if self.num_val_samples and 'val_features' in self.data:
+                if epoch_end:
+                    self._submit_eval()
+                self._collect_evals()
+
+        self._collect_evals(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
         # At the end of training swap the best params into the model
-        # self.model.params = self.best_params
+        if self.best_params:
+            self.model.params = self.best_params
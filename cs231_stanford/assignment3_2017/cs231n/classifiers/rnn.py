@@ -10,6 +10,24 @@ def debug(v):
     print(v, '=', repr(eval(v)))
 
 
+_executors = {}
+
+
+def _get_executor(num_threads):
+    """
+    Thread pools are shared between models and created on first use, so that
+    models stay picklable.
+    """
+    if not num_threads or num_threads <= 1:
+        return None
+    if num_threads not in _executors:
+        # Imported here so that single-threaded models also load on Python 2,
+        # where concurrent.futures needs the futures backport.
+        from concurrent.futures import ThreadPoolExecutor
+        _executors[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+    return _executors[num_threads]
+
+
 class CaptioningRNN(object):
     """
     A CaptioningRNN produces captions from image features using a recurrent
@@ -23,7 +41,8 @@ class CaptioningRNN(object):
     """
 
     def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-                 hidden_dim=128, cell_type='rnn', dtype=np.float32):
+                 hidden_dim=128, cell_type='rnn', num_layers=1, num_threads=None,
+                 fuse_embedding=False, dtype=np.float32):
         """
         Construct a new CaptioningRNN instance.
 
@@ -33,14 +52,27 @@ class CaptioningRNN(object):
         - input_dim: Dimension D of input image feature vectors.
         - wordvec_dim: Dimension W of word vectors.
         - hidden_dim: Dimension H for the hidden state of the RNN.
-        - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
+        - cell_type: What type of RNN to use; either 'rnn', 'lstm' or 'gru'.
+        - num_layers: Number of stacked recurrent layers. Parameters of layer
+          l > 0 are stored as 'Wx%d', 'Wh%d' and 'b%d' % l.
+        - num_threads: If greater than 1, stacked layers are run in wavefronts
+          on a thread pool of this size so that layers overlap.
+        - fuse_embedding: If True, the training loss projects the embedding
+          table through Wx once per call and gathers rows of W_embed.dot(Wx),
+          instead of embedding the captions and then multiplying by Wx. This is
+          cheaper when V is small compared to N * T.
         - dtype: numpy datatype to use; use float32 for training and float64 for
           numeric gradient checking.
         """
-        if cell_type not in {'rnn', 'lstm'}:
+        if cell_type not in {'rnn', 'lstm', 'gru'}:
             raise ValueError('Invalid cell_type "%s"' % cell_type)
+        if num_layers < 1:
+            raise ValueError('Invalid num_layers %d' % num_layers)
 
         self.cell_type = cell_type
+        self.num_layers = num_layers
+        self.num_threads = num_threads
+        self.fuse_embedding = fuse_embedding
         self.dtype = dtype
         self.word_to_idx = word_to_idx
         self.idx_to_word = {i: w for w, i in word_to_idx.items()}
@@ -62,12 +94,15 @@ class CaptioningRNN(object):
         self.params['b_proj'] = np.zeros(hidden_dim)
 
         # Initialize parameters for the RNN
-        dim_mul = {'lstm': 4, 'rnn': 1}[cell_type]
-        self.params['Wx'] = np.random.randn(wordvec_dim, dim_mul * hidden_dim)
-        self.params['Wx'] /= np.sqrt(wordvec_dim)
-        self.params['Wh'] = np.random.randn(hidden_dim, dim_mul * hidden_dim)
-        self.params['Wh'] /= np.sqrt(hidden_dim)
-        self.params['b'] = np.zeros(dim_mul * hidden_dim)
+        dim_mul = {'lstm': 4, 'gru': 3, 'rnn': 1}[cell_type]
+        for l in range(num_layers):
+            Wx_key, Wh_key, b_key = self._layer_keys(l)
+            input_dim_l = wordvec_dim if l == 0 else hidden_dim
+            self.params[Wx_key] = np.random.randn(input_dim_l, dim_mul * hidden_dim)
+            self.params[Wx_key] /= np.sqrt(input_dim_l)
+            self.params[Wh_key] = np.random.randn(hidden_dim, dim_mul * hidden_dim)
+            self.params[Wh_key] /= np.sqrt(hidden_dim)
+            self.params[b_key] = np.zeros(dim_mul * hidden_dim)
 
         # Initialize output to vocab weights
         self.params['W_vocab'] = np.random.randn(hidden_dim, vocab_size)
@@ -78,6 +113,18 @@ class CaptioningRNN(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(self.dtype)
 
+    def _layer_keys(self, l):
+        """
+        Names of the (Wx, Wh, b) parameters of recurrent layer l.
+        """
+        if l == 0:
+            return 'Wx', 'Wh', 'b'
+        return 'Wx%d' % l, 'Wh%d' % l, 'b%d' % l
+
+    def _layers(self):
+        return [tuple(self.params[k] for k in self._layer_keys(l))
+                for l in range(self.num_layers)]
+
     def loss(self, features, captions):
         """
         Compute training-time loss for the RNN. We input image features and
@@ -153,15 +200,28 @@ class CaptioningRNN(object):
         h0, h0_c = affine_forward(features, W_proj, b_proj)  # (N, H)
         # print('h0 (%s %s)\n' % h0.shape)
 
-        # (2) Word embedding layer
-        word_embed, word_embed_c = word_embedding_forward(captions_in, W_embed)  # (N, T, W)
+        # (2) Word embedding layer. When fused, the input-to-hidden projection
+        # of the first layer is folded in, giving (N, T, kH) instead.
+        layers = self._layers()
+        if self.fuse_embedding:
+            word_embed, word_embed_c = fused_embedding_forward(captions_in, W_embed, Wx)
+            Wx = None
+            layers[0] = (None,) + layers[0][1:]
+        else:
+            word_embed, word_embed_c = word_embedding_forward(captions_in, W_embed)  # (N, T, W)
 
         # (3) Hidden states
-        if self.cell_type == 'rnn':
+        if self.num_layers > 1:
+            forward, forward_c = stacked_forward(word_embed, h0, layers,
+                                                 self.cell_type,
+                                                 _get_executor(self.num_threads))
+        elif self.cell_type == 'rnn':
             forward, forward_c = rnn_forward(word_embed, h0, Wx, Wh, b)  # (N, T, H)
             # print('forward', forward.shape)  # (N, T, H)
         elif self.cell_type == 'lstm':
             forward, forward_c = lstm_forward(word_embed, h0, Wx, Wh, b)  # (N, T, H)
+        elif self.cell_type == 'gru':
+            forward, forward_c = gru_forward(word_embed, h0, Wx, Wh, b)  # (N, T, H)
 
         # (4) Temporal affine transformation
         vocab_forward, vocab_forward_c = temporal_affine_forward(forward, W_vocab, b_vocab)
@@ -174,14 +234,26 @@ class CaptioningRNN(object):
         d_forward, grads['W_vocab'], grads['b_vocab'] = \
             temporal_affine_backward(dx, vocab_forward_c)
 
-        if self.cell_type == 'rnn':
+        if self.num_layers > 1:
+            d_word_embed, d_h0, layer_grads = stacked_backward(d_forward, forward_c)
+            for l, layer_grad in enumerate(layer_grads):
+                for k, g in zip(self._layer_keys(l), layer_grad):
+                    grads[k] = g
+        elif self.cell_type == 'rnn':
             d_word_embed, d_h0, grads['Wx'], grads['Wh'], grads['b'] = \
                 rnn_backward(d_forward, forward_c)
         elif self.cell_type == 'lstm':
             d_word_embed, d_h0, grads['Wx'], grads['Wh'], grads['b'] = \
                 lstm_backward(d_forward, forward_c)
+        elif self.cell_type == 'gru':
+            d_word_embed, d_h0, grads['Wx'], grads['Wh'], grads['b'] = \
+                gru_backward(d_forward, forward_c)
 
-        grads['W_embed'] = word_embedding_backward(d_word_embed, word_embed_c)
+        if self.fuse_embedding:
+            grads['W_embed'], grads['Wx'] = \
+                fused_embedding_backward(d_word_embed, word_embed_c)
+        else:
+            grads['W_embed'] = word_embedding_backward(d_word_embed, word_embed_c)
         _, grads['W_proj'], grads['b_proj'] = affine_backward(d_h0, h0_c)
 
         ############################################################################
@@ -220,7 +292,7 @@ class CaptioningRNN(object):
         # Unpack parameters
         W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
         W_embed = self.params['W_embed']
-        Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
+        layers = self._layers()
         W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
 
         ###########################################################################
@@ -257,16 +329,18 @@ class CaptioningRNN(object):
         # Convert the vocabulary idx to a vector representation
         word_embed = word_embedding_forward(start, W_embed)[0].reshape((N, -1))  # (N, D)
 
-        # For lstm
-        next_c = np.zeros(next_hidden.shape)
+        # Every layer starts from the projected features; cells for lstm
+        hiddens = [next_hidden] * self.num_layers
+        cells = [np.zeros(next_hidden.shape)] * self.num_layers
 
         for i in range(max_length):
-            # use word embedding to get next hidden layer
-            if self.cell_type == 'rnn':
-                next_hidden, _ = rnn_step_forward(word_embed, next_hidden, Wx, Wh, b)  # (N, H)
-            elif self.cell_type == 'lstm':
-                next_hidden, next_c, _ = \
-                    lstm_step_forward(word_embed, next_hidden, next_c, Wx, Wh, b)  # (N, H)
+            # use word embedding to get next hidden layer of each stacked layer
+            layer_input = word_embed
+            for l, (Wx, Wh, b) in enumerate(layers):
+                hiddens[l], cells[l], _ = cell_step_forward(
+                    self.cell_type, layer_input, hiddens[l], cells[l], Wx, Wh, b)  # (N, H)
+                layer_input = hiddens[l]
+            next_hidden = hiddens[-1]
 
             # get score outputs for the words
             word_scores = affine_forward(next_hidden, W_vocab, b_vocab)[0]  # (N, V)
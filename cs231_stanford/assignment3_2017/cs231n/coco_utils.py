@@ -1,5 +1,6 @@
 from builtins import range
 import os, json
+from collections import namedtuple
 import numpy as np
 import h5py
 
@@ -54,27 +55,110 @@ def load_coco_data(base_dir=BASE_DIR,
     return data
 
 
+VocabLookup = namedtuple('VocabLookup', ['words', 'null', 'end'])
+
+
+def vocab_lookup(idx_to_word):
+    """
+    Precompute what decode_captions needs from a vocabulary: an object array
+    mapping ids to words, and the ids of the <NULL> and <END> tokens.
+
+    Inputs:
+    - idx_to_word: List or dict mapping integer ids to words, as found in the
+      data returned by load_coco_data.
+
+    Returns:
+    - lookup: A VocabLookup that can be passed to decode_captions in place of
+      idx_to_word, to avoid rebuilding it on every call.
+    """
+    if isinstance(idx_to_word, VocabLookup):
+        return idx_to_word
+    if isinstance(idx_to_word, dict):
+        V = max(idx_to_word) + 1
+        words = np.empty(V, dtype=object)
+        words[:] = ''
+        for i, w in idx_to_word.items():
+            words[i] = w
+    else:
+        words = np.empty(len(idx_to_word), dtype=object)
+        words[:] = list(idx_to_word)
+    null = np.flatnonzero(words == '<NULL>')
+    end = np.flatnonzero(words == '<END>')
+    return VocabLookup(words,
+                       null[0] if null.shape[0] > 0 else -1,
+                       end[0] if end.shape[0] > 0 else -1)
+
+
 def decode_captions(captions, idx_to_word):
+    lookup = vocab_lookup(idx_to_word)
     singleton = False
     if captions.ndim == 1:
         singleton = True
         captions = captions[None]
-    decoded = []
     N, T = captions.shape
-    for i in range(N):
-        words = []
-        for t in range(T):
-            word = idx_to_word[captions[i, t]]
-            if word != '<NULL>':
-                words.append(word)
-            if word == '<END>':
-                break
-        decoded.append(' '.join(words))
+    if N == 0:
+        return []
+
+    # Keep everything up to and including the first <END>, minus <NULL>s
+    is_end = (captions == lookup.end)
+    last = np.where(is_end.any(axis=1), is_end.argmax(axis=1), T - 1)
+    keep = (np.arange(T)[None, :] <= last[:, None]) & (captions != lookup.null)
+
+    words = lookup.words[captions[keep]]
+    splits = np.cumsum(keep.sum(axis=1))[:-1]
+    decoded = [' '.join(row) for row in np.split(words, splits)]
     if singleton:
         decoded = decoded[0]
     return decoded
 
 
+def write_captions(f, captions, idx_to_word, urls=None):
+    """
+    Decode captions and stream them to a file, one caption per line.
+
+    Inputs:
+    - f: A filename or an open text file object.
+    - captions: Integer array of shape (N, T), or an iterable of such arrays
+      (e.g. a generator yielding sampled batches), so that the full set never
+      has to be held in memory.
+    - idx_to_word: List, dict or VocabLookup giving the vocabulary.
+    - urls: Optional array or iterable of arrays parallel to captions; if given
+      each line is written as "url<TAB>caption". Every url batch must have as
+      many entries as its caption batch.
+
+    Returns:
+    - count: Number of captions written.
+    """
+    lookup = vocab_lookup(idx_to_word)
+    if isinstance(captions, np.ndarray):
+        captions = [captions]
+        # atleast_1d keeps a single url string from being split into chars
+        urls = [np.atleast_1d(urls)] if urls is not None else None
+    url_batches = iter(urls) if urls is not None else None
+
+    if isinstance(f, str):
+        with open(f, 'w') as fh:
+            return write_captions(fh, captions, lookup,
+                                  urls=url_batches if urls is not None else None)
+
+    count = 0
+    for batch in captions:
+        decoded = decode_captions(np.atleast_2d(batch), lookup)
+        # Advance the urls even for an empty batch to stay aligned
+        batch_urls = next(url_batches) if url_batches is not None else None
+        if batch_urls is not None and len(batch_urls) != len(decoded):
+            raise ValueError('Got %d urls for a batch of %d captions'
+                             % (len(batch_urls), len(decoded)))
+        if not decoded:
+            continue
+        if batch_urls is not None:
+            decoded = ['%s\t%s' % (u, c) for u, c in zip(batch_urls, decoded)]
+        f.write('\n'.join(decoded))
+        f.write('\n')
+        count += len(decoded)
+    return count
+
+
 def sample_coco_minibatch(data, batch_size=100, split='train'):
     split_size = data['%s_captions' % split].shape[0]
     mask = np.random.choice(split_size, batch_size)
@@ -8,6 +8,29 @@ networks.
 """
 
 
+def project_input(x, Wx):
+    """
+    Input-to-hidden projection used by the recurrent cells. If Wx is None, x is
+    taken to be already projected (see fused_embedding_forward).
+    """
+    if Wx is None:
+        return x
+    return x.dot(Wx)
+
+
+def project_input_backward(dA, x, Wx):
+    """
+    Backward pass for project_input.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x
+    - dWx: Gradient with respect to Wx, or None if Wx is None
+    """
+    if Wx is None:
+        return dA, None
+    return dA.dot(Wx.T), x.T.dot(dA)
+
+
 def rnn_step_forward(x, prev_h, Wx, Wh, b):
     """
     Run the forward pass for a single timestep of a vanilla RNN that uses a tanh
@@ -33,7 +56,7 @@ def rnn_step_forward(x, prev_h, Wx, Wh, b):
     # hidden state and any values you need for the backward pass in the next_h   #
     # and cache variables respectively.                                          #
     ##############################################################################
-    x_Wx = x.dot(Wx)
+    x_Wx = project_input(x, Wx)
     prev_h_Wh = prev_h.dot(Wh)
     ws = x_Wx + prev_h_Wh + b  # Weight sum
     next_h = np.tanh(ws)
@@ -77,11 +100,8 @@ def rnn_step_backward(dnext_h, cache):
     # Wh.shape = (H, H)
     dprev_h = dtanh.dot(Wh.T)  # (N, H)
 
-    # x.shape = (N,D)
-    dWx = x.T.dot(dtanh)  # (D, H)
-
-    # Wx = (D, H)
-    dx = dtanh.dot(Wx.T)  # (N, D)
+    # x.shape = (N,D), Wx = (D, H)
+    dx, dWx = project_input_backward(dtanh, x, Wx)  # (N, D), (D, H)
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -153,7 +173,7 @@ def rnn_backward(dh, cache):
     # print("N: %s, D: %s, T: %s, H: %s" % (N, D, T, H))
     dx = np.zeros((N, T, D))
     dh0 = np.zeros(prev_h.shape)
-    dWx = np.zeros(Wx.shape)
+    dWx = np.zeros(Wx.shape) if Wx is not None else None
     dWh = np.zeros(Wh.shape)
     db = np.zeros(H)
     _dh = 0
@@ -164,7 +184,8 @@ def rnn_backward(dh, cache):
         _dx, _dh, _dWx, _dWh, _db = rnn_step_backward(dh_c, cache[i])
         dx[:, i, :] += _dx
         dh0 = _dh
-        dWx += _dWx
+        if dWx is not None:
+            dWx += _dWx
         dWh += _dWh
         db += _db
     ##############################################################################
@@ -286,7 +307,7 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     # - forget gate, f_g, determines how much of prev_c is remembered
     #   - from [0, 1) it either maintain prev_c or squish to zero
     # - input gate, i_g, is influenced by block input g (-1, 1)
-    A = x.dot(Wx) + prev_h.dot(Wh) + b  # (N, 4H)
+    A = project_input(x, Wx) + prev_h.dot(Wh) + b  # (N, 4H)
     ai, af, ao, ag = np.split(A, 4, axis=1)  # (N, H)
     i_g, f_g, o_g, g_g = sigmoid(ai), sigmoid(af), sigmoid(ao), np.tanh(ag)  # (N, H)
     next_c = f_g * prev_c + i_g * g_g  # (N, H)
@@ -335,8 +356,7 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     dag = (1 - g_g ** 2) * dg_g
 
     dA = np.hstack((dai, daf, dao, dag))
-    dx = dA.dot(Wx.T)  # (N, 4H) . (4H, D)
-    dWx = x.T.dot(dA)  # (D, N) . (N, 4H)
+    dx, dWx = project_input_backward(dA, x, Wx)  # (N, 4H) . (4H, D), (D, N) . (N, 4H)
     dprev_h = dA.dot(Wh.T)
     dWh = prev_h.T.dot(dA)
     db = np.ones(dA.shape[0]).dot(dA)
@@ -414,7 +434,7 @@ def lstm_backward(dh, cache):
     _, D = x.shape
     N, T, H = dh.shape
     dx = np.zeros((N, T, D))
-    dWx = np.zeros(Wx.shape)
+    dWx = np.zeros(Wx.shape) if Wx is not None else None
     dWh = np.zeros(Wh.shape)
     db = np.zeros(4 * H)
     _dprev_c = np.zeros(prev_c.shape)
@@ -426,7 +446,8 @@ def lstm_backward(dh, cache):
         _dx, _dh, _dprev_c, _dWx, _dWh, _db = lstm_step_backward(dh_c, _dprev_c, cache[i])
         dx[:, i, :] += _dx
         dh0 = _dh
-        dWx += _dWx
+        if dWx is not None:
+            dWx += _dWx
         dWh += _dWh
         db += _db
     ##############################################################################
@@ -436,6 +457,337 @@ def lstm_backward(dh, cache):
     return dx, dh0, dWx, dWh, db
 
 
+def gru_step_forward(x, prev_h, Wx, Wh, b):
+    """
+    Forward pass for a single timestep of a GRU.
+
+    The gates are packed in the order reset (r), update (z), candidate (n):
+      r = sigmoid(x Wx_r + prev_h Wh_r + b_r)
+      z = sigmoid(x Wx_z + prev_h Wh_z + b_z)
+      n = tanh(x Wx_n + b_n + r * (prev_h Wh_n))
+      next_h = (1 - z) * n + z * prev_h
+
+    Inputs:
+    - x: Input data, of shape (N, D)
+    - prev_h: Previous hidden state, of shape (N, H)
+    - Wx: Input-to-hidden weights, of shape (D, 3H)
+    - Wh: Hidden-to-hidden weights, of shape (H, 3H)
+    - b: Biases, of shape (3H,)
+
+    Returns a tuple of:
+    - next_h: Next hidden state, of shape (N, H)
+    - cache: Tuple of values needed for backward pass.
+    """
+    H = prev_h.shape[1]
+    Ax = project_input(x, Wx) + b  # (N, 3H)
+    Ah = prev_h.dot(Wh)  # (N, 3H)
+    r = sigmoid(Ax[:, :H] + Ah[:, :H])
+    z = sigmoid(Ax[:, H:2 * H] + Ah[:, H:2 * H])
+    ah_n = Ah[:, 2 * H:]
+    n = np.tanh(Ax[:, 2 * H:] + r * ah_n)
+    next_h = (1 - z) * n + z * prev_h
+    cache = r, z, n, ah_n, Wx, x, prev_h, Wh
+    return next_h, cache
+
+
+def gru_step_backward(dnext_h, cache):
+    """
+    Backward pass for a single timestep of a GRU.
+
+    Inputs:
+    - dnext_h: Gradients of next hidden state, of shape (N, H)
+    - cache: Values from the forward pass
+
+    Returns a tuple of:
+    - dx: Gradient of input data, of shape (N, D)
+    - dprev_h: Gradient of previous hidden state, of shape (N, H)
+    - dWx: Gradient of input-to-hidden weights, of shape (D, 3H)
+    - dWh: Gradient of hidden-to-hidden weights, of shape (H, 3H)
+    - db: Gradient of biases, of shape (3H,)
+    """
+    r, z, n, ah_n, Wx, x, prev_h, Wh = cache
+    dn = dnext_h * (1 - z)
+    dz = dnext_h * (prev_h - n)
+    dan = dn * (1 - n ** 2)
+    dar = dan * ah_n * r * (1 - r)
+    daz = dz * z * (1 - z)
+
+    dAx = np.hstack((dar, daz, dan))  # (N, 3H)
+    dAh = np.hstack((dar, daz, dan * r))  # (N, 3H)
+    dx, dWx = project_input_backward(dAx, x, Wx)
+    db = dAx.sum(axis=0)
+    dprev_h = dnext_h * z + dAh.dot(Wh.T)
+    dWh = prev_h.T.dot(dAh)
+    return dx, dprev_h, dWx, dWh, db
+
+
+def gru_forward(x, h0, Wx, Wh, b):
+    """
+    Forward pass for a GRU over an entire sequence of data.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - h0: Initial hidden state of shape (N, H)
+    - Wx: Weights for input-to-hidden connections, of shape (D, 3H)
+    - Wh: Weights for hidden-to-hidden connections, of shape (H, 3H)
+    - b: Biases of shape (3H,)
+
+    Returns a tuple of:
+    - h: Hidden states for all timesteps of all sequences, of shape (N, T, H)
+    - cache: Values needed for the backward pass.
+    """
+    N, T, D = x.shape
+    _, H = h0.shape
+    h = np.zeros((N, T, H))
+    cache = [None] * T
+    for i in range(T):
+        h0, c = gru_step_forward(x[:, i, :], h0, Wx, Wh, b)
+        h[:, i, :] = h0
+        cache[i] = c
+    return h, cache
+
+
+def gru_backward(dh, cache):
+    """
+    Backward pass for a GRU over an entire sequence of data.
+
+    Inputs:
+    - dh: Upstream gradients of hidden states, of shape (N, T, H)
+    - cache: Values from the forward pass
+
+    Returns a tuple of:
+    - dx: Gradient of input data of shape (N, T, D)
+    - dh0: Gradient of initial hidden state of shape (N, H)
+    - dWx: Gradient of input-to-hidden weight matrix of shape (D, 3H)
+    - dWh: Gradient of hidden-to-hidden weight matrix of shape (H, 3H)
+    - db: Gradient of biases, of shape (3H,)
+    """
+    _, _, _, _, Wx, x, prev_h, Wh = cache[0]
+    _, D = x.shape
+    N, T, H = dh.shape
+    dx = np.zeros((N, T, D))
+    dWx = np.zeros(Wx.shape) if Wx is not None else None
+    dWh = np.zeros(Wh.shape)
+    db = np.zeros(3 * H)
+    _dh = np.zeros(prev_h.shape)
+
+    for i in reversed(range(T)):
+        _dx, _dh, _dWx, _dWh, _db = gru_step_backward(dh[:, i, :] + _dh, cache[i])
+        dx[:, i, :] = _dx
+        if dWx is not None:
+            dWx += _dWx
+        dWh += _dWh
+        db += _db
+    return dx, _dh, dWx, dWh, db
+
+
+def cell_step_forward(cell_type, x, prev_h, prev_c, Wx, Wh, b):
+    """
+    Run a single timestep of any supported cell type ('rnn', 'lstm' or 'gru')
+    through one interface. prev_c is only used by the LSTM; other cells pass it
+    through unchanged.
+
+    Returns a tuple of:
+    - next_h: Next hidden state, of shape (N, H)
+    - next_c: Next cell state, of shape (N, H), or prev_c
+    - cache: Values needed for cell_step_backward.
+    """
+    if cell_type == 'rnn':
+        next_h, cache = rnn_step_forward(x, prev_h, Wx, Wh, b)
+        return next_h, prev_c, cache
+    elif cell_type == 'lstm':
+        return lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b)
+    elif cell_type == 'gru':
+        next_h, cache = gru_step_forward(x, prev_h, Wx, Wh, b)
+        return next_h, prev_c, cache
+    raise ValueError('Invalid cell_type "%s"' % cell_type)
+
+
+def cell_step_backward(cell_type, dnext_h, dnext_c, cache):
+    """
+    Backward pass matching cell_step_forward.
+
+    Returns a tuple of (dx, dprev_h, dprev_c, dWx, dWh, db); dprev_c is
+    dnext_c passed through for cells without a cell state.
+    """
+    if cell_type == 'rnn':
+        dx, dprev_h, dWx, dWh, db = rnn_step_backward(dnext_h, cache)
+        return dx, dprev_h, dnext_c, dWx, dWh, db
+    elif cell_type == 'lstm':
+        return lstm_step_backward(dnext_h, dnext_c, cache)
+    elif cell_type == 'gru':
+        dx, dprev_h, dWx, dWh, db = gru_step_backward(dnext_h, cache)
+        return dx, dprev_h, dnext_c, dWx, dWh, db
+    raise ValueError('Invalid cell_type "%s"' % cell_type)
+
+
+def _wavefronts(L, T, reverse=False):
+    """
+    Group the (layer, timestep) cells of an L x T recurrence by anti-diagonal
+    l + t. Cell (l, t) depends only on (l - 1, t) and (l, t - 1), so all cells
+    on one diagonal can run at the same time.
+    """
+    diagonals = range(L + T - 1)
+    if reverse:
+        diagonals = reversed(diagonals)
+    for d in diagonals:
+        yield [(l, d - l) for l in range(max(0, d - T + 1), min(L, d + 1))]
+
+
+def _run_wavefront(fn, cells, executor):
+    if executor is None or len(cells) == 1:
+        return [fn(cell) for cell in cells]
+    return list(executor.map(fn, cells))
+
+
+def stacked_forward(x, h0, layers, cell_type='lstm', executor=None):
+    """
+    Forward pass for a stack of recurrent layers over an entire sequence. The
+    hidden states of layer l are the inputs of layer l + 1, and every layer
+    starts from the same initial hidden state h0 (and a zero cell state).
+
+    Cells are scheduled in wavefronts: layer l runs timestep t as soon as layer
+    l - 1 has produced it. If executor (e.g. a ThreadPoolExecutor) is given, the
+    cells of each wavefront are run concurrently on it; NumPy releases the GIL
+    inside the matrix multiplies, so the layers overlap.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - h0: Initial hidden state of shape (N, H)
+    - layers: List of L tuples (Wx, Wh, b), one per layer, bottom first. The
+      first layer's Wx has shape (D, kH) and the rest have shape (H, kH), where
+      k is 1, 4 or 3 for 'rnn', 'lstm' or 'gru'. The first layer's Wx may be
+      None if x is already projected to shape (N, T, kH).
+    - cell_type: 'rnn', 'lstm' or 'gru'
+    - executor: Optional concurrent.futures.Executor.
+
+    Returns a tuple of:
+    - h: Hidden states of the top layer, of shape (N, T, H)
+    - cache: Values needed for the backward pass.
+    """
+    N, T, D = x.shape
+    _, H = h0.shape
+    L = len(layers)
+    hs = [[None] * T for _ in range(L)]
+    cs = [[None] * T for _ in range(L)]
+    caches = [[None] * T for _ in range(L)]
+    c0 = np.zeros((N, H))
+
+    def step(cell):
+        l, t = cell
+        inp = x[:, t, :] if l == 0 else hs[l - 1][t]
+        prev_h = h0 if t == 0 else hs[l][t - 1]
+        prev_c = c0 if t == 0 else cs[l][t - 1]
+        Wx, Wh, b = layers[l]
+        return cell_step_forward(cell_type, inp, prev_h, prev_c, Wx, Wh, b)
+
+    for cells in _wavefronts(L, T):
+        for (l, t), out in zip(cells, _run_wavefront(step, cells, executor)):
+            hs[l][t], cs[l][t], caches[l][t] = out
+
+    h = np.stack(hs[-1], axis=1)
+    cache = (cell_type, caches, D, executor)
+    return h, cache
+
+
+def stacked_backward(dh, cache):
+    """
+    Backward pass for stacked_forward, scheduled in reverse wavefronts.
+
+    Inputs:
+    - dh: Upstream gradients of the top layer's hidden states, of shape
+      (N, T, H)
+    - cache: Values from the forward pass
+
+    Returns a tuple of:
+    - dx: Gradient of input data of shape (N, T, D)
+    - dh0: Gradient of the shared initial hidden state of shape (N, H)
+    - grads: List of L tuples (dWx, dWh, db) parallel to layers.
+    """
+    cell_type, caches, D, executor = cache
+    N, T, H = dh.shape
+    L = len(caches)
+    dx = np.zeros((N, T, D))
+    dh0 = np.zeros((N, H))
+    dc0 = np.zeros((N, H))
+    # Gradients flowing into each cell: from above (dinp) and from t + 1 (drec)
+    dinp = [[None] * T for _ in range(L)]
+    drec_h = [np.zeros((N, H)) for _ in range(L)]
+    drec_c = [np.zeros((N, H)) for _ in range(L)]
+    grads = [None] * L
+
+    def step(cell):
+        l, t = cell
+        dnext_h = drec_h[l] + (dh[:, t, :] if l == L - 1 else dinp[l + 1][t])
+        return cell_step_backward(cell_type, dnext_h, drec_c[l], caches[l][t])
+
+    for cells in _wavefronts(L, T, reverse=True):
+        for (l, t), out in zip(cells, _run_wavefront(step, cells, executor)):
+            _dx, drec_h[l], drec_c[l], dWx, dWh, db = out
+            if l == 0:
+                dx[:, t, :] = _dx
+            else:
+                dinp[l][t] = _dx
+            if grads[l] is None:
+                grads[l] = [dWx, dWh, db]
+            else:
+                if dWx is not None:
+                    grads[l][0] = grads[l][0] + dWx
+                grads[l][1] = grads[l][1] + dWh
+                grads[l][2] = grads[l][2] + db
+            if t == 0:
+                dh0 += drec_h[l]
+
+    return dx, dh0, [tuple(g) for g in grads]
+
+
+def fused_embedding_forward(x, W_embed, Wx):
+    """
+    Forward pass for a word embedding followed directly by the input-to-hidden
+    projection of a recurrent layer. Since W_embed[x].dot(Wx) equals
+    W_embed.dot(Wx)[x], we project the V x W embedding table once and gather
+    rows of the result, instead of materialising the (N, T, W) embeddings and
+    multiplying them by Wx.
+
+    Feed the output to rnn_forward / lstm_forward / gru_forward (or the first
+    layer of stacked_forward) with Wx=None.
+
+    Inputs:
+    - x: Integer array of shape (N, T) giving indices of words.
+    - W_embed: Word vectors of shape (V, W).
+    - Wx: Input-to-hidden weights of shape (W, kH).
+
+    Returns a tuple of:
+    - out: Projected inputs of shape (N, T, kH).
+    - cache: Values needed for the backward pass
+    """
+    table = W_embed.dot(Wx)  # (V, kH)
+    out = table[x]
+    cache = (x, W_embed, Wx)
+    return out, cache
+
+
+def fused_embedding_backward(dout, cache):
+    """
+    Backward pass for fused_embedding_forward. The upstream gradients are
+    scattered into a (V, kH) table first, and then routed to both factors.
+
+    Inputs:
+    - dout: Upstream gradients of shape (N, T, kH)
+    - cache: Values from the forward pass
+
+    Returns a tuple of:
+    - dW_embed: Gradient of the word embedding matrix, of shape (V, W)
+    - dWx: Gradient of the input-to-hidden weights, of shape (W, kH)
+    """
+    x, W_embed, Wx = cache
+    dtable = np.zeros((W_embed.shape[0], Wx.shape[1]))
+    np.add.at(dtable, x, dout)
+    dW_embed = dtable.dot(Wx.T)
+    dWx = W_embed.T.dot(dtable)
+    return dW_embed, dWx
+
+
 def temporal_affine_forward(x, w, b):
     """
     Forward pass for a temporal affine layer. The input is a set of D-dimensional